@@ -21,7 +21,8 @@ __all__ = [
         'select_trigger', 'thread_loop', 'sync_stdio', 
         'async_net', 'async_chat', 'producer', 'collector', 'reactor', 
         'async_limits', 'async_server', 'async_client', 
-        'synchronized', 'timeouts',
+        'synchronized', 'timeouts', 'prefork', 'asyncio_loop', 'benchmark',
+        'watchdog', 'recorder', 'async_datagram',
         ]
 
 __author__ = 'Laurent A.V. Szyster <laurentszyster@gmail.com>'
\ No newline at end of file
@@ -44,10 +44,10 @@ import collections, socket
 from allegra import async_core
 
 
-def find_prefix_at_end (haystack, needle):
+def find_prefix_at_end (haystack, needle, start=0, end=None):
         "given 'haystack', see if any prefix of 'needle' is at its end."
         l = len (needle) - 1
-        while l and not haystack.endswith (needle[:l]):
+        while l and not haystack.endswith (needle[:l], start, end):
                 l -= 1
         return l
 
@@ -105,17 +105,80 @@ def collect_chat (c, buffer):
         return buffer
 
 
-class Dispatcher (async_core.Dispatcher):
+def collect_ring (c, ring, read, write):
+        "collect a ring's bytes from read to write, return the next read"
+        while read < write:
+                terminator = c.get_terminator ()
+                if terminator is None or terminator == '':
+                        c.collect_incoming_data (
+                                str (buffer (ring, read, write - read))
+                                )
+                        read = write
+                elif isinstance (terminator, int):
+                        if write - read < terminator:
+                                c.collect_incoming_data (
+                                        str (buffer (ring, read, write - read))
+                                        )
+                                c.set_terminator (terminator - write + read)
+                                read = write
+                        else:
+                                c.collect_incoming_data (
+                                        str (buffer (ring, read, terminator))
+                                        )
+                                read += terminator
+                                c.set_terminator (0)
+                                if c.found_terminator ():
+                                        c.collector_stalled = True
+                                        break
+
+                else:
+                        index = ring.find (terminator, read, write)
+                        if index != -1:
+                                if index > read:
+                                        c.collect_incoming_data (
+                                                str (buffer (
+                                                        ring, read, index - read
+                                                        ))
+                                                )
+                                read = index + len (terminator)
+                                if c.found_terminator ():
+                                        c.collector_stalled = True
+                                        break
+                                
+                        else:
+                                index = find_prefix_at_end (
+                                        ring, terminator, read, write
+                                        )
+                                if write - index > read:
+                                        c.collect_incoming_data (str (buffer (
+                                                ring, read, write - index - read
+                                                )))
+                                read = write - index
+                                break
+                                
+        return read
+        #
+        # the same collection than collect_chat, without slicing what
+        # is left to collect: the ring is searched between cursors and
+        # only the bytes collected are copied, once, in a string.
+
+
+class Dispatcher_base (async_core.Dispatcher_base):
+
+        __slots__ = ()
 
         ac_in_buffer_size = ac_out_buffer_size = 1 << 14
         
+        ac_out_offset = 0
+        
+        ac_in_buffer = ''
+        
         terminator = None
         collector_stalled = False
         collector_is_simple = False
         collector_depth = 32
         
         def __init__ (self):
-                self.ac_in_buffer = ''
                 self.ac_out_buffer = ''
                 self.output_fifo = collections.deque ()
 
@@ -126,18 +189,17 @@ class Dispatcher (async_core.Dispatcher):
                 "predicate for inclusion in the poll loop for input"
                 return not (
                         self.collector_stalled or
-                        len (self.ac_in_buffer) > self.ac_in_buffer_size
+                        len (self.ac_in_buffer) >= self.ac_in_buffer_size
                         )
 
         def writable (self):
                 "predicate for inclusion in the poll loop for output"
                 try:
-                        return not (
-                                self.output_fifo[
-                                        0
-                                        ].producer_stalled () and
-                                self.connected
-                                )
+                        if self.output_fifo[0].producer_stalled ():
+                                self.async_interest () # predicate again
+                                return not self.connected
+                        
+                        return True
                 
                 except:
                         return not (
@@ -147,27 +209,53 @@ class Dispatcher (async_core.Dispatcher):
                                 )
 
         def handle_read (self):
-                "try to refill the input buffer and collect it"
+                "try to receive into the loop's scratch buffer and collect"
+                left = self.ac_in_buffer
+                size = self.ac_in_buffer_size
+                if len (left) >= size:
+                        return # full, until collected
+                
+                scratch = self.async_loop.scratch (size)
+                scratch[:len (left)] = left
                 try:
-                        data = self.recv (self.ac_in_buffer_size)
+                        received = self.recv_into (
+                                memoryview (scratch)[len (left):size]
+                                )
                 except socket.error, why:
                         self.handle_error ()
                         return
 
-                self.ac_in_buffer = collect_chat (
-                        self, self.ac_in_buffer + data
-                        )
+                write = len (left) + received
+                read = collect_ring (self, scratch, 0, write)
+                if read < write:
+                        self.ac_in_buffer = str (
+                                buffer (scratch, read, write - read)
+                                )
+                else:
+                        self.ac_in_buffer = ''
+                #
+                # input is received after what was left in the loop's 
+                # scratch buffer and collected in place, only the bytes not 
+                # consumed - an incomplete terminator or what a stalled 
+                # collector did not collect - are copied in a string kept
+                # by the dispatcher: an idle connection holds no buffer. 
 
         def handle_write (self):
-                "maybe refill the output buffer and try to send it"
+                "maybe gather more output and try to send it from offset"
                 obs = self.ac_out_buffer_size
-                buffer = self.ac_out_buffer
-                if len (buffer) < obs:
+                out = self.ac_out_buffer
+                offset = self.ac_out_offset
+                size = len (out) - offset
+                if size < obs:
+                        if size > 0:
+                                gathered = [out[offset:]]
+                        else:
+                                gathered = []
                         fifo = self.output_fifo
-                        while fifo:
+                        while fifo and size < obs:
                                 p = fifo[0]
                                 if p == None:
-                                        if buffer == '':
+                                        if size == 0:
                                                 fifo.popleft ()
                                                 self.handle_close () 
                                                 return
@@ -175,34 +263,50 @@ class Dispatcher (async_core.Dispatcher):
                                         break
                                     
                                 elif type (p) == str:
-                                        fifo.popleft ()
-                                        buffer += p
-                                        if len (buffer) < obs:
-                                                continue
+                                        if size > 0 and size + len (p) > obs:
+                                                break # send it alone next
                                         
-                                        break
+                                        fifo.popleft ()
+                                        gathered.append (p)
+                                        size += len (p)
+                                        continue
                                 
                                 if p.producer_stalled ():
                                         break
                                 
+                                if (
+                                        size == 0 and 
+                                        hasattr (p, 'producer_sendfile') and
+                                        p.producer_sendfile (self) != None
+                                        ):
+                                        return # sent from its file
+                                
                                 data = p.more ()
                                 if data:
-                                        buffer += data
-                                        break
-                                    
-                                fifo.popleft ()
-                if buffer:
-                        sent = self.send (buffer[:obs])
-                        if sent:
-                                self.ac_out_buffer = buffer[sent:]
-                        else:
-                                self.ac_out_buffer = buffer
-                else:
-                        self.ac_out_buffer = ''
+                                        gathered.append (data)
+                                        size += len (data)
+                                else:
+                                        fifo.popleft ()
+                        out = ''.join (gathered)
+                        offset = 0
+                if out:
+                        offset += self.send (buffer (out, offset, obs))
+                        if offset < len (out):
+                                self.ac_out_buffer = out
+                                self.ac_out_offset = offset
+                                return
+                        
+                self.ac_out_buffer = ''
+                self.ac_out_offset = 0
+                #
+                # strings and chunks smaller than the output buffer are
+                # gathered in one string, a larger one is sent alone and
+                # without a copy: partial sends move the offset in the
+                # string sent instead of slicing what is left to send.
                         
         def close (self):
                 "close the dispatcher and maybe terminate the collector"
-                async_core.Dispatcher.close (self)
+                super (Dispatcher_base, self).close ()
                 if not self.collector_stalled:
                         depth = self.collector_depth
                         while depth and not self.found_terminator (): 
@@ -218,6 +322,7 @@ class Dispatcher (async_core.Dispatcher):
                 is empty, or handle close now if it is allready empty"""
                 if self.output_fifo:
                         self.output_fifo.append (None)
+                        self.async_interest ()
                 else:
                         self.handle_close () # when done is now!
 
@@ -225,6 +330,7 @@ class Dispatcher (async_core.Dispatcher):
                 "push a string or producer on the output deque"
                 assert type (p) == str or hasattr (p, 'more')
                 self.output_fifo.append (p)
+                self.async_interest ()
                 
         # push_with_producer = push = async_chat_push
 
@@ -235,6 +341,7 @@ class Dispatcher (async_core.Dispatcher):
                         self.ac_in_buffer = collect_chat (
                                 self, self.ac_in_buffer
                                 )
+                self.async_interest ()
 
         def set_terminator (self, terminator):
                 "set the channel's terminator"
@@ -254,6 +361,30 @@ class Dispatcher (async_core.Dispatcher):
                         self.get_terminator (), 'found-terminator'
                         )
                 return True # do not pipeline 
+
+
+class Dispatcher (Dispatcher_base, async_core.Dispatcher): pass
+
+
+class Dispatcher_with_slots (
+        Dispatcher_base, async_core.Dispatcher_with_slots
+        ):
+
+        __slots__ = (
+                'ac_out_buffer', 'ac_out_offset', 'output_fifo',
+                'ac_in_buffer', 'terminator', 'collector_stalled'
+                )
+
+        def __init__ (self):
+                async_core.Dispatcher_with_slots.__init__ (self)
+                Dispatcher_base.__init__ (self)
+                self.ac_out_offset = 0
+                self.ac_in_buffer = ''
+                self.terminator = None
+                self.collector_stalled = False
+
+        # the close method of Dispatcher_base calls the next one in the
+        # MRO, so a slotted channel accounts its built-in meters too.
         
 # Note about this implementation
 #
@@ -282,3 +413,12 @@ class Dispatcher (async_core.Dispatcher):
 # the current terminator is found, and if that method returns True, then
 # no more buffer will be consumed until the channel's collector_stalled
 # is not set to False by a call to async_collect.
+#
+# Announced Interest
+#
+# The async_chat_push, async_chat_pull and close_when_done methods announce
+# the changes of interest they make, so a subclass may set async_announce
+# to True and be predicated by the loop only when something happens. A
+# stalled producer is predicated again at each iteration until it resumes,
+# but anything else that changes the readable or writable state outside of
+# the channel's handlers must call async_interest too.
@@ -24,11 +24,13 @@ try:
 except:
         SOCKET_FAMILIES = (socket.AF_INET, )
 
-from allegra import loginfo, async_loop, async_limits
+from allegra import loginfo, async_loop, async_core, async_limits
         
         
-def connect (dispatcher, addr, timeout=3.0, family=socket.AF_INET):
-        "create a socket, try to connect it and schedule a timeout"
+def connect (
+        dispatcher, addr, timeout=3.0, family=socket.AF_INET, options=()
+        ):
+        "create and tune a socket, try to connect it, schedule a timeout"
         assert (
                 not dispatcher.connected and timeout > 0 and
                 family in SOCKET_FAMILIES
@@ -37,6 +39,8 @@ def connect (dispatcher, addr, timeout=3.0, family=socket.AF_INET):
         dispatcher.client_timeout = timeout
         try:
                 dispatcher.create_socket (family, socket.SOCK_STREAM)
+                if options:
+                        async_core.socket_tune (dispatcher.socket, options)
                 dispatcher.connect (addr)
         except:
                 dispatcher.loginfo_traceback ()
@@ -54,20 +58,21 @@ def connect (dispatcher, addr, timeout=3.0, family=socket.AF_INET):
                                 )
                         dispatcher.handle_close ()
 
-        async_loop.schedule (
+        dispatcher.async_schedule (
                 dispatcher.client_when + timeout, connect_timeout
                 )
         return True
 
 
-def reconnect (dispatcher):
+def reconnect (dispatcher, options=()):
         if dispatcher.addr:
                 dispatcher.closing = False
                 return connect (
                         dispatcher, 
                         dispatcher.addr, 
                         dispatcher.client_timeout, 
-                        dispatcher.family_and_type[0]
+                        dispatcher.family_and_type[0],
+                        options
                         )
                         
         return False
@@ -79,6 +84,9 @@ class Connections (loginfo.Loginfo):
 
         ac_in_meter = ac_out_meter = 0
         client_errors = client_when = client_dispatched = 0
+        client_scheduled = None
+        client_socket_options = ()
+        async_loop = async_loop
         
         def __init__ (
                 self, timeout=3.0, precision=1.0, family=socket.AF_INET
@@ -113,11 +121,14 @@ class Connections (loginfo.Loginfo):
         def client_connect (self, dispatcher, name):
                 "resolve and/or connect a dispatcher"
                 dispatcher.client_name = name
+                if self.async_loop is not async_loop:
+                        async_loop.bind (self.async_loop, dispatcher)
                 addr = self.client_resolved (name)
                 if addr != None:
                         return connect (
                                 dispatcher, addr, 
-                                self.client_timeout, self.client_family
+                                self.client_timeout, self.client_family,
+                                self.client_socket_options
                                 )
 
                 if self.client_resolve == None:
@@ -131,7 +142,8 @@ class Connections (loginfo.Loginfo):
                         
                         if not connect (
                                 dispatcher, addr, 
-                                self.client_timeout, self.client_family
+                                self.client_timeout, self.client_family,
+                                self.client_socket_options
                                 ):
                                 self.client_errors += 1
                                 
@@ -154,7 +166,7 @@ class Connections (loginfo.Loginfo):
         def client_start (self, when):
                 "handle the client management startup"
                 self.client_when = when
-                async_loop.schedule (
+                self.client_scheduled = self.async_loop.schedule (
                         when + self.client_precision, self.client_manage
                         )
                 assert None == self.log ('start', 'debug')
@@ -211,6 +223,9 @@ class Connections (loginfo.Loginfo):
                                 self.ac_in_meter,
                                 self.ac_out_meter
                                 ), 'debug')
+                if self.client_scheduled != None:
+                        self.client_scheduled.cancel ()
+                        self.client_scheduled = None
                 self.client_errors = self.client_dispatched = \
                         self.ac_in_meter = self.ac_out_meter = 0
 
@@ -330,16 +345,36 @@ def resolved (connections):
         return connections
 
 
+def tuned (connections, *profiles):
+        "tune the sockets connected, log the values set on a probe"
+        options = async_core.socket_options (profiles)
+        connections.client_socket_options = options
+        probe = socket.socket (connections.client_family, socket.SOCK_STREAM)
+        try:
+                async_core.socket_tune (probe, options)
+                connections.log ('tuned %s' % async_core.socket_tuned (
+                        probe, options
+                        ), 'info')
+        finally:
+                probe.close ()
+        return connections
+        #
+        # there is no socket to read the values back from until one is
+        # connected, so they are set on a probe socket and logged once, 
+        # at startup, instead of for each connection.
+
+
 def meter (dispatcher, when):
         "decorate a client dispatcher with stream meters"
         async_limits.meter_recv (dispatcher, when)
         async_limits.meter_send (dispatcher, when)
+        if dispatcher.ac_metered:
+                return # closes and accounts its meters itself
+                
         def close ():
-                del (
-                        dispatcher.recv, 
-                        dispatcher.send, 
-                        dispatcher.close
-                        )
+                async_limits.unmeter_recv (dispatcher)
+                async_limits.unmeter_send (dispatcher)
+                del dispatcher.close
                 dispatcher.close ()
                 dispatcher.async_client.client_close (dispatcher)
                 
@@ -388,9 +423,9 @@ def limited (connections, timeout, inBps, outBps):
                         dispatcher, when, connections.ac_out_throttle_Bps
                         )
                 def close ():
+                        async_limits.unmeter_recv (dispatcher)
+                        async_limits.unmeter_send (dispatcher)
                         del (
-                                dispatcher.recv, 
-                                dispatcher.send, 
                                 dispatcher.readable,
                                 dispatcher.writable,
                                 dispatcher.close
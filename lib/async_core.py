@@ -51,8 +51,83 @@ from errno import (
 
 from allegra import loginfo, async_loop, finalization
 
+try:
+        from os import sendfile
+except ImportError:
+        try:
+                from sendfile import sendfile # pysendfile, for Python 2
+        except ImportError:
+                sendfile = None
+
+
+# Socket Options Profiles
+
+def socket_option (level, name, value):
+        "return a profile of one (name, level, option, value), or empty"
+        option = getattr (socket, name, None)
+        if option == None:
+                return ()
+        
+        return ((name, level, option, value), )
+
+SOCKET_PROFILES = {
+        'latency': socket_option (socket.IPPROTO_TCP, 'TCP_NODELAY', 1),
+        'bulk': (
+                socket_option (socket.SOL_SOCKET, 'SO_SNDBUF', 1 << 20) +
+                socket_option (socket.SOL_SOCKET, 'SO_RCVBUF', 1 << 20)
+                ),
+        'keepalive': (
+                socket_option (socket.SOL_SOCKET, 'SO_KEEPALIVE', 1) +
+                socket_option (socket.IPPROTO_TCP, 'TCP_KEEPIDLE', 60) +
+                socket_option (socket.IPPROTO_TCP, 'TCP_KEEPINTVL', 10) +
+                socket_option (socket.IPPROTO_TCP, 'TCP_KEEPCNT', 6)
+                ),
+        'defer_accept': socket_option (
+                socket.IPPROTO_TCP, 'TCP_DEFER_ACCEPT', 1
+                ),
+        }
+
+def socket_options (profiles):
+        "return the options of named profiles, in order"
+        options = ()
+        for name in profiles:
+                options += SOCKET_PROFILES[name]
+        return options
+
+def socket_tune (sock, options):
+        "set options on a socket, skip the ones it does not support"
+        for name, level, option, value in options:
+                try:
+                        sock.setsockopt (level, option, value)
+                except socket.error:
+                        pass
 
-class Dispatcher (loginfo.Loginfo, finalization.Finalization):
+def socket_tuned (sock, options):
+        "return the options' values of a socket, as a loggable string"
+        tuned = []
+        for name, level, option, value in options:
+                try:
+                        tuned.append ('%s="%d"' % (
+                                name, sock.getsockopt (level, option)
+                                ))
+                except socket.error:
+                        tuned.append ('%s="?"' % name)
+        return ' '.join (tuned)
+        #
+        # Options that the platform does not define are dropped from the 
+        # profiles, those a socket does not support are skipped when they 
+        # are set and logged as "?". Tune the kernel buffers only for bulk 
+        # transfers: setting them disables their automatic tuning on Linux.
+        #
+        # A profile is a tuple of options, merge them with socket_options
+        # or add your own to SOCKET_PROFILES.
+
+
+class Dispatcher_base (
+        loginfo.Loginfo_base, finalization.Finalization_base
+        ):
+        
+        __slots__ = ()
         
         connected = accepting = closing = False
         socket = addr = family_and_type = _fileno = None
@@ -133,6 +208,10 @@ class Dispatcher (loginfo.Loginfo, finalization.Finalization):
                         pass # closing a
                 self.socket = None 
                 self.del_channel ()
+                if self.async_scheduled:
+                        for event in self.async_scheduled:
+                                event.cancel ()
+                        self.async_scheduled = ()
                 self.connected = False
                 self.closing = True # == (self.socket == None)
                 assert None == self.log ('close', 'debug')
@@ -185,6 +264,25 @@ class Dispatcher (loginfo.Loginfo, finalization.Finalization):
                         else:
                                 raise
 
+        def recv_into (self, buffer, nbytes=0):
+                "try to receive bytes into a buffer or handle close"
+                try:
+                        received = self.socket.recv_into (buffer, nbytes)
+                        if received == 0:
+                                self.handle_close ()
+                        return received
+                
+                except MemoryError:
+                        sys.exit ("Out of Memory!") # do not even try to log!
+                        
+                except socket.error, why:
+                        if why[0] in [ECONNRESET, ENOTCONN, ESHUTDOWN]:
+                                self.handle_close ()
+                                return 0
+                                
+                        else:
+                                raise
+
         def sendto (self, data, peer):
                 "try to send data through a datagram socket"
                 try:
@@ -205,7 +303,10 @@ class Dispatcher (loginfo.Loginfo, finalization.Finalization):
                         return self.socket.recvfrom (datagram_size)
 
                 except socket.error, why:
-                        if why[0] in [ECONNRESET, ENOTCONN, ESHUTDOWN]:
+                        if why[0] == EWOULDBLOCK:
+                                return '', None
+                                
+                        elif why[0] in [ECONNRESET, ENOTCONN, ESHUTDOWN]:
                                 self.handle_close()
                                 return '', None
                                 
@@ -214,11 +315,23 @@ class Dispatcher (loginfo.Loginfo, finalization.Finalization):
 
         # The "iner" API applied in async_loop
 
+        async_loop = async_loop
         async_map = async_loop._dispatched
+        async_announced = async_loop._announced
+        async_announce = False
+        async_scheduled = ()
+        async_priorities = async_loop._priorities
+        async_priority = 0
+        
+        ac_metered = False
     
         def add_channel (self):
                 "add the dispatcher to the asynchronous I/O map"
                 self.async_map[self._fileno] = self
+                self.async_announced[self._fileno] = self
+                if self.async_priority:
+                        self.async_priorities[self._fileno] = \
+                                self.async_priority
 
         def del_channel (self):
                 "removes the dispatcher from the asynchronous I/O map"
@@ -227,6 +340,28 @@ class Dispatcher (loginfo.Loginfo, finalization.Finalization):
                         del self.async_map[fd]
                 except KeyError:
                         pass
+                else:
+                        self.async_loop._io_unregister (fd)
+
+        def async_interest (self):
+                "announce a change of readable or writable interest"
+                if self.async_announce:
+                        self.async_announced[self._fileno] = self
+
+        def async_prioritize (self, priority):
+                "set the priority, higher than 0 first, lower than 0 last"
+                self.async_priority = priority
+                if self.async_map.get (self._fileno) is self:
+                        if priority:
+                                self.async_priorities[self._fileno] = priority
+                        else:
+                                self.async_priorities.pop (self._fileno, None)
+
+        def async_schedule (self, when, scheduled):
+                "schedule an event cancelled when the dispatcher closes"
+                event = self.async_loop.schedule (when, scheduled)
+                self.async_scheduled += (event, )
+                return event
 
         def readable (self):
                 "predicate for inclusion as readable in the poll loop"
@@ -300,6 +435,11 @@ class Dispatcher (loginfo.Loginfo, finalization.Finalization):
                 assert None == self.log ('finalized', 'debug')
 
 
+class Dispatcher (
+        Dispatcher_base, loginfo.Loginfo, finalization.Finalization
+        ): pass
+
+
 # Asynchronous File I/O: UNIX pipe and stdio only
 #
 # What follows is the original comments by Sam Rushing:
@@ -328,6 +468,11 @@ if os.name == 'posix':
                 def recv (self, *args):
                         return apply (os.read, (self.fd, ) + args)
         
+                def recv_into (self, buffer, nbytes=0):
+                        data = os.read (self.fd, nbytes or len (buffer))
+                        buffer[:len (data)] = data
+                        return len (data)
+        
                 def send (self, *args):
                         return apply (os.write, (self.fd, ) + args)
         
@@ -349,7 +494,131 @@ if os.name == 'posix':
                 self.add_channel ()
                 self.connected = True
 
-        Dispatcher.set_file = set_file
+        Dispatcher_base.set_file = set_file
+
+
+if sendfile != None:
+
+        def dispatcher_sendfile (self, fd, offset, count):
+                "try to send count bytes of a file from offset, or 0"
+                try:
+                        return sendfile (self._fileno, fd, offset, count)
+                
+                except (OSError, socket.error), why:
+                        if why[0] in (EWOULDBLOCK, EINTR):
+                                return 0
+                        
+                        raise
+                        
+        Dispatcher_base.sendfile = dispatcher_sendfile
+
+
+# Slotted Dispatcher
+
+class Dispatcher_with_slots (Dispatcher_base):
+        
+        __slots__ = (
+                'socket', 'addr', 'family_and_type', '_fileno', 
+                'connected', 'accepting', 'closing',
+                'async_loop', 'async_map', 'async_announced', 
+                'async_priorities', 'async_finalized', 
+                'async_scheduled', 'async_priority',
+                'ac_in_meter', 'ac_in_when', 'ac_out_meter', 'ac_out_when',
+                'async_server', 'server_name', 'server_when', 
+                'async_client', 'client_key', 'client_name', 
+                'client_when', 'client_timeout', 'limit_inactive',
+                'finalization'
+                )
+        
+        ac_metered = True
+        
+        def __init__ (self):
+                self.socket = self.addr = self.family_and_type = None
+                self._fileno = None
+                self.connected = self.accepting = self.closing = False
+                self.async_loop = async_loop
+                self.async_map = async_loop._dispatched
+                self.async_announced = async_loop._announced
+                self.async_priorities = async_loop._priorities
+                self.async_finalized = async_loop._finalized
+                self.async_scheduled = ()
+                self.async_priority = 0
+                self.ac_in_meter = self.ac_out_meter = 0
+                self.ac_in_when = self.ac_out_when = time.time ()
+                self.async_server = self.server_name = None
+                self.async_client = self.client_key = self.client_name = None
+                self.server_when = self.client_when = 0
+                self.client_timeout = self.limit_inactive = None
+                self.finalization = None
+
+        def close (self):
+                "close, then account the meters to a server or a client"
+                Dispatcher_base.close (self)
+                if self.async_server != None:
+                        self.async_server.server_close (self)
+                elif self.async_client != None:
+                        self.async_client.client_close (self)
+
+        def send (self, data):
+                "try to send data through a stream socket, meter output"
+                sent = Dispatcher_base.send (self, data)
+                self.ac_out_meter += sent
+                self.ac_out_when = time.time ()
+                return sent
+
+        def recv (self, buffer_size):
+                "try to receive bytes from a stream socket, meter input"
+                data = Dispatcher_base.recv (self, buffer_size)
+                self.ac_in_meter += len (data)
+                self.ac_in_when = time.time ()
+                return data
+
+        def recv_into (self, buffer, nbytes=0):
+                "try to receive bytes into a buffer, meter input"
+                received = Dispatcher_base.recv_into (self, buffer, nbytes)
+                self.ac_in_meter += received
+                self.ac_in_when = time.time ()
+                return received
+
+        def sendto (self, data, peer):
+                "try to send data through a datagram socket, meter output"
+                sent = Dispatcher_base.sendto (self, data, peer)
+                self.ac_out_meter += sent
+                self.ac_out_when = time.time ()
+                return sent
+
+        def recvfrom (self, datagram_size):
+                "try to receive from a datagram socket, meter input"
+                data, peer = Dispatcher_base.recvfrom (self, datagram_size)
+                self.ac_in_meter += len (data)
+                self.ac_in_when = time.time ()
+                return data, peer
+
+        if sendfile != None:
+        
+                def sendfile (self, fd, offset, count):
+                        "try to send count bytes of a file, meter output"
+                        sent = dispatcher_sendfile (self, fd, offset, count)
+                        self.ac_out_meter += sent
+                        self.ac_out_when = time.time ()
+                        return sent
+        
+        # A dispatcher without an instance dictionary, for peers that hold
+        # tens of thousands of mostly idle connections: a dictionary costs
+        # more than all the attributes it holds.
+        #
+        # The I/O meters that async_limits decorates with closures are
+        # built in as slotted counters, and the close method accounts them
+        # to the async_server or async_client that manages the dispatcher.
+        # So async_limits.meter_* only reset the counters and the server's
+        # or client's meter decorations do not wrap close.
+        #
+        # Slotted subclasses must declare their own __slots__, even empty,
+        # or their instances get a dictionary back. Throttling decorators
+        # and loginfo_toggle set attributes that have no slot: they are not
+        # supported. The finalization is a slot set to None, a dispatcher
+        # is not finalized unless one is assigned to it, and a subclass
+        # may not define it as a method.
 
 
 # Conveniences
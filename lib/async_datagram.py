@@ -0,0 +1,112 @@
+# Copyright (C) 2005 Laurent A.V. Szyster
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+#    http://www.gnu.org/copyleft/gpl.html
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"http://laurentszyster.be/blog/async_datagram/"
+
+import collections, socket
+
+from allegra import async_core
+
+
+class Dispatcher (async_core.Dispatcher):
+
+        ac_in_datagram_size = 1 << 16
+        ac_in_batch = ac_out_batch = 64
+        
+        def __init__ (self):
+                self.output_fifo = collections.deque ()
+
+        def __repr__ (self):
+                return 'async-datagram id="%x"' % id (self)
+                
+        def async_datagram_bind (self, addr, family=socket.AF_INET):
+                "create a datagram socket, bind it and add the dispatcher"
+                self.create_socket (family, socket.SOCK_DGRAM)
+                self.bind (addr)
+                self.connected = True
+
+        def readable (self):
+                "predicate for inclusion in the poll loop for input"
+                return True
+
+        def writable (self):
+                "predicate for inclusion in the poll loop for output"
+                return len (self.output_fifo) > 0
+
+        def handle_read (self):
+                "receive and continue a batch of datagrams"
+                recvfrom = self.recvfrom
+                size = self.ac_in_datagram_size
+                for i in xrange (self.ac_in_batch):
+                        data, peer = recvfrom (size)
+                        if peer == None:
+                                return # would block or closed
+                        
+                        self.async_datagram_continue (data, peer)
+                        if self.closing:
+                                return
+
+        def handle_write (self):
+                "send a batch of queued (data, peer) datagrams"
+                sendto = self.sendto
+                fifo = self.output_fifo
+                for i in xrange (self.ac_out_batch):
+                        if not fifo:
+                                break
+                        
+                        data, peer = fifo[0]
+                        try:
+                                if sendto (data, peer) == 0 and data:
+                                        break # would block
+                                
+                        except socket.error, why:
+                                self.log (
+                                        '%r %s' % (peer, why), 
+                                        'async-datagram-error'
+                                        )
+                        fifo.popleft ()
+                if not fifo:
+                        self.async_interest ()
+
+        def async_datagram_push (self, data, peer):
+                "queue a datagram to send to a peer"
+                self.output_fifo.append ((data, peer))
+                self.async_interest ()
+
+        def async_datagram_continue (self, data, peer):
+                "assert debug log of datagrams received"
+                assert None == self.log (
+                        '%r %r' % (peer, data), 'async-datagram-continue'
+                        )
+
+
+# Note about this implementation
+#
+# Without recvmmsg and sendmmsg in Python 2, a batch is a loop of recvfrom
+# or sendto calls at each readiness event, until the socket would block
+# or the batch is done. It saves the poll and the dispatch of an event
+# for each datagram, which costs more than the system call itself.
+#
+# The batch calls the dispatcher's recvfrom and sendto methods, so that
+# the meters and throttles of async_limits.limit_datagram apply. A
+# throttle is checked once per event, an input or output batch may
+# overshoot it by as many datagrams.
+#
+# A datagram that cannot be sent because it would block stays first in
+# the output queue until the next write event. One that fails with any
+# other error - too large, an unreachable peer - is logged and dropped
+# instead of closing a dispatcher shared by all peers.
\ No newline at end of file
@@ -19,8 +19,6 @@
 
 import time
 
-from allegra import async_loop
-
 
 # Metering for stream and datagram sockets
 
@@ -28,6 +26,9 @@ def meter_recv (dispatcher, when):
         "decorate a stream transport with an input meter"
 	dispatcher.ac_in_meter = 0
 	dispatcher.ac_in_when = when
+	if dispatcher.ac_metered:
+		return # built in
+		
 	metered_recv = dispatcher.recv
 	def recv (buffer_size):
 		data = metered_recv (buffer_size)
@@ -36,11 +37,22 @@ def meter_recv (dispatcher, when):
 	        return data
 	        
 	dispatcher.recv = recv
+	metered_recv_into = dispatcher.recv_into
+	def recv_into (buffer, nbytes=0):
+		received = metered_recv_into (buffer, nbytes)
+	        dispatcher.ac_in_meter += received
+		dispatcher.ac_in_when = time.time ()
+	        return received
+	        
+	dispatcher.recv_into = recv_into
 
 def meter_send (dispatcher, when):
         "decorate a stream transport with an output meter"
 	dispatcher.ac_out_meter = 0
 	dispatcher.ac_out_when = when
+	if dispatcher.ac_metered:
+		return # built in
+		
 	metered_send = dispatcher.send
 	def send (data):
 		sent = metered_send (data)
@@ -49,11 +61,23 @@ def meter_send (dispatcher, when):
 	        return sent
 	        
 	dispatcher.send = send
+	if hasattr (dispatcher, 'sendfile'):
+		metered_sendfile = dispatcher.sendfile
+		def sendfile (fd, offset, count):
+			sent = metered_sendfile (fd, offset, count)
+			dispatcher.ac_out_meter += sent
+			dispatcher.ac_out_when = time.time ()
+			return sent
+			
+		dispatcher.sendfile = sendfile
 
 def meter_recvfrom (dispatcher, when):
         "decorate a datagram transport with an input meter"
         dispatcher.ac_in_meter = 0
         dispatcher.ac_in_when = when
+        if dispatcher.ac_metered:
+                return # built in
+                
         metered_recvfrom = dispatcher.recvfrom
         def recvfrom (datagram_size):
                 data, peer = metered_recvfrom (datagram_size)
@@ -67,8 +91,11 @@ def meter_sendto (dispatcher, when):
         "decorate a datagram transport with an output meter"
         dispatcher.ac_out_meter = 0
         dispatcher.ac_out_when = when
+        if dispatcher.ac_metered:
+                return # built in
+                
 	metered_sendto = dispatcher.sendto
-	def sendto (self):
+	def sendto (data, peer):
 		sent = metered_sendto (data, peer)
 	        dispatcher.ac_out_meter += sent
 		dispatcher.ac_out_when = time.time ()
@@ -76,6 +103,36 @@ def meter_sendto (dispatcher, when):
 
 	dispatcher.sendto = sendto
 
+def unmeter_recv (dispatcher):
+        "remove the input meter of a stream transport"
+        if dispatcher.ac_metered:
+                return # built in
+                
+        del dispatcher.recv, dispatcher.recv_into
+
+def unmeter_send (dispatcher):
+        "remove the output meter of a stream transport"
+        if dispatcher.ac_metered:
+                return # built in
+                
+        del dispatcher.send
+        if dispatcher.__dict__.has_key ('sendfile'):
+                del dispatcher.sendfile
+
+def unmeter_recvfrom (dispatcher):
+        "remove the input meter of a datagram transport"
+        if dispatcher.ac_metered:
+                return # built in
+                
+        del dispatcher.recvfrom
+
+def unmeter_sendto (dispatcher):
+        "remove the output meter of a datagram transport"
+        if dispatcher.ac_metered:
+                return # built in
+                
+        del dispatcher.sendto
+
 
 # Inactivity Limits
 
@@ -140,6 +197,7 @@ def throttle_in (dispatcher, when):
                                 dispatcher.ac_in_throttle_when
                                 )
                         ) * dispatcher.ac_in_throttle_Bps ())
+                dispatcher.async_interest ()
         dispatcher.ac_in_throttle_when = when
         return False
 
@@ -165,6 +223,7 @@ def throttle_out (dispatcher, when):
 				dispatcher.ac_out_throttle_when
 				)
 			) * dispatcher.ac_out_throttle_Bps ())
+                dispatcher.async_interest ()
 	dispatcher.ac_out_throttle_when = when	
         return False
 	
@@ -197,9 +256,13 @@ def limit_schedule (dispatcher, when, interval, limit, unlimit):
                 # recur at interval
                 return (when + interval, scheduled)
         
-        async_loop.schedule (when + interval, scheduled)
+        dispatcher.async_loop.schedule (when + interval, scheduled)
 
         # I like that one (nested namespaces rule ,-)
+        #
+        # the recurrence is not cancelled when the dispatcher closes: it
+        # must run once more to unlimit the dispatcher, or the decorations
+        # left in its __dict__ would hold it in an uncollectable cycle.
 
 
 # Conveniences: ready-made metering, inactivity check and throttling
@@ -239,10 +302,10 @@ def limit_recv (dispatcher, interval, timeout, Bps):
 
 def unlimit_recv (dispatcher):
         "unmeter recv and unthrottle readable"
+        unmeter_recv (dispatcher)
         del (
-                dispatcher.recv, 
                 dispatcher.readable, 
-                dispatcher.ac_in_throttle_Bps 
+                dispatcher.ac_in_throttle_Bps
                 )
 
 def limit_send (dispatcher, interval, timeout, Bps):
@@ -257,8 +320,8 @@ def limit_send (dispatcher, interval, timeout, Bps):
 
 def unlimit_send (dispatcher):
         "unmeter send and unthrottle writable"
+        unmeter_send (dispatcher)
         del (
-                dispatcher.send, 
                 dispatcher.writable, 
                 dispatcher.ac_out_throttle_Bps
                 )
@@ -277,11 +340,11 @@ def limit_stream (dispatcher, interval, timeout, inBps, outBps):
 
 def unlimit_stream (dispatcher):
         "unmeter and unthrottle stream I/O"
+        unmeter_recv (dispatcher)
+        unmeter_send (dispatcher)
         del (
-                dispatcher.recv, 
                 dispatcher.readable,
                 dispatcher.ac_in_throttle_Bps,
-                dispatcher.send, 
                 dispatcher.writable, 
                 dispatcher.ac_out_throttle_Bps
                 )
@@ -300,8 +363,8 @@ def limit_recvfrom (dispatcher, interval, timeout, Bps):
 
 def unlimit_recvfrom (dispatcher):
         "unmeter recvfrom and unthrottle readable"
+        unmeter_recvfrom (dispatcher)
         del (
-                dispatcher.recvfrom, 
                 dispatcher.readable, 
                 dispatcher.ac_in_throttle_Bps
                 )
@@ -318,8 +381,8 @@ def limit_sendto (dispatcher, interval, timeout, Bps):
 
 def unlimit_sendto (dispatcher):
         "unmeter sendto and unthrottle writable"
+        unmeter_sendto (dispatcher)
         del (
-                dispatcher.sendto, 
                 dispatcher.writable,
                 dispatcher.ac_out_throttle_Bps
                 )
@@ -331,18 +394,18 @@ def limit_datagram (dispatcher, interval, timeout, inBps, outBps):
         meter_recvfrom (dispatcher, when)
         throttle_readable (dispatcher, when, inBps)
         meter_sendto (dispatcher, when)
-        throttle_writable (dispatcher, when, inBps)
+        throttle_writable (dispatcher, when, outBps)
         limit_schedule (
                 dispatcher, when, interval, limit, unlimit_datagram
                 )
 
 def unlimit_datagram (dispatcher):
         "unmeter and unthrottle datagram I/O"
+        unmeter_recvfrom (dispatcher)
+        unmeter_sendto (dispatcher)
         del (
-                dispatcher.recvfrom, 
                 dispatcher.readable, 
                 dispatcher.ac_in_throttle_Bps,
-                dispatcher.sendto, 
                 dispatcher.writable,
                 dispatcher.ac_out_throttle_Bps
                 )
@@ -39,7 +39,7 @@
 
 "http://laurentszyster.be/blog/async_loop/"
 
-import gc, select, errno, time, collections, heapq
+import gc, select, errno, time, collections, heapq, math, types, bisect
 
 from allegra import loginfo
 
@@ -47,26 +47,142 @@ from allegra import loginfo
 Exit = KeyboardInterrupt
 
 
+# Poll Interests (readable/writable predicates or announcements)
+
+_interests = {}
+
+_announced = {}
+
+def _io_interest (map):
+        "update the interests announced or predicated, return the changes"
+        changed = []
+        announced = _announced.items ()
+        _announced.clear ()
+        for fd, dispatcher in announced:
+                if map.get (fd) is not dispatcher:
+                        continue # deleted or replaced since announced
+                
+                if not dispatcher.async_announce:
+                        _announced[fd] = dispatcher # predicate again
+                if dispatcher.readable ():
+                        if dispatcher.writable ():
+                                mask = 3
+                        else:
+                                mask = 1
+                elif dispatcher.writable ():
+                        mask = 2
+                else:
+                        mask = 0
+                interest = _interests.get (fd, 0)
+                if interest != mask:
+                        if mask:
+                                _interests[fd] = mask
+                        else:
+                                del _interests[fd]
+                        changed.append ((fd, interest, mask))
+        return changed
+        #
+        # dispatchers that do not announce changes of their interest are
+        # predicated at each iteration, as before, while those that do are
+        # predicated only when they announce it or after they handled an
+        # I/O event, so that the cost of a loop is proportional to its
+        # activity instead of the number of dispatchers.
+
+
+# Poll Concurrency (a fair window of interests)
+
+_io_cursor = 0
+
+_io_waits = None
+
+def _io_window (limit):
+        "return a window of at most limit interests, rotating over all"
+        global _io_cursor
+        concurrent = _interests.items ()
+        count = len (concurrent)
+        if count > limit:
+                start = _io_cursor % count
+                _io_cursor = end = start + limit
+                if end > count:
+                        concurrent = (
+                                concurrent[start:] + concurrent[:end - count]
+                                )
+                else:
+                        concurrent = concurrent[start:end]
+        if _io_waits != None:
+                _io_waited (concurrent)
+        return concurrent
+        #
+        # when there are more interests than the concurrency limit, the 
+        # window rotates so that each dispatcher is polled at least once 
+        # every len (_interests) / limit iterations, instead of starving 
+        # all but the first limit dispatchers in the map.
+
+def _io_waited (concurrent):
+        "account the time each dispatcher waited to be polled again"
+        now = time.time ()
+        waits = _io_waits
+        for fd, mask in concurrent:
+                try:
+                        waited = waits[fd]
+                except KeyError:
+                        waits[fd] = [now, 0, 0.0, 0.0]
+                        continue
+                
+                wait = now - waited[0]
+                waited[0] = now
+                waited[1] += 1
+                waited[2] += wait
+                if wait > waited[3]:
+                        waited[3] = wait
+
+
+# Poll Priorities (control before data)
+
+_priorities = {}
+
+low_concurrency = 64
+
+def _io_prioritize (events):
+        "order ready events by priority, limit the low priority ones"
+        high = []
+        normal = []
+        low = []
+        for event in events:
+                priority = _priorities.get (event[0], 0)
+                if priority == 0:
+                        normal.append (event)
+                elif priority > 0:
+                        high.append (event)
+                elif len (low) < low_concurrency:
+                        low.append (event)
+        return high + normal + low
+        #
+        # the low priority events left out are reported again by the next
+        # poll, so a bulk of low priority dispatchers cannot delay others
+        # more than low_concurrency handlers per iteration.
+
+
 # Poll I/O
 
 def _io_select (map, timeout, limit):
         "poll for I/O a limited number of writable/readable dispatchers"
+        _io_interest (map)
         r = []
         w = []
-        concurrent = map.items ()
-        rest = limit - len (concurrent)
-        if rest < 0:
-                concurrent = concurrent[:limit]
-        else:
-                rest = 0
-        for fd, dispatcher in concurrent:
-                if dispatcher.readable ():
+        concurrent = _io_window (limit)
+        for fd, mask in concurrent:
+                if mask & 1:
                         r.append (fd)
-                if dispatcher.writable ():
+                if mask & 2:
                         w.append (fd)
+        if timeout == None and (
+                not concurrent or len (concurrent) < len (_interests)
+                ):
+                timeout = precision # poll soon the ones left out
         if len (r) + len (w) == 0:
                 time.sleep (timeout)
-                return limit - rest, 0
+                return len (concurrent), 0
 
         try:
                 r, w, e = select.select (r, w, [], timeout)
@@ -75,8 +191,22 @@ def _io_select (map, timeout, limit):
                     raise
                     
                 else:
-                    return limit - rest, 0
+                    return len (concurrent), 0
 
+        if _meters != None:
+                _meters.meters_polled = time.time ()
+        if _priorities:
+                r = [event[0] for event in _io_prioritize (
+                        [(fd, 1) for fd in r]
+                        )]
+                w = [event[0] for event in _io_prioritize (
+                        [(fd, 2) for fd in w]
+                        )]
+        profiled = _profiled
+        if profiled != None:
+                profiled.profile_polled (
+                        [(fd, 1) for fd in r] + [(fd, 4) for fd in w]
+                        ) # as POLLIN and POLLOUT
         for fd in r:
                 try:
                         dispatcher = map[fd]
@@ -84,12 +214,16 @@ def _io_select (map, timeout, limit):
                         continue
 
                 try:
-                        dispatcher.handle_read_event ()
+                        if profiled == None:
+                                dispatcher.handle_read_event ()
+                        else:
+                                profiled.profile_io (dispatcher, True, False)
                 except Exit:
                         raise
                         
                 except:
                         dispatcher.handle_error ()
+                _announced.setdefault (fd, dispatcher)
         for fd in w:
                 try:
                         dispatcher = map[fd]
@@ -97,13 +231,17 @@ def _io_select (map, timeout, limit):
                         continue
 
                 try:
-                        dispatcher.handle_write_event ()
+                        if profiled == None:
+                                dispatcher.handle_write_event ()
+                        else:
+                                profiled.profile_io (dispatcher, False, True)
                 except Exit:
                         raise 
                         
                 except:
                         dispatcher.handle_error ()
-        return limit - rest, len (r) + len (w)
+                _announced.setdefault (fd, dispatcher)
+        return len (concurrent), len (r) + len (w)
         #
         # note that the number of distinct active dispatchers may actually
         # be lower than the one reported: to get an exact cound would
@@ -111,75 +249,244 @@ def _io_select (map, timeout, limit):
 
 def _io_poll (map, timeout, limit):
         "poll for I/O a limited number of writable/readable dispatchers"
-        timeout = int (timeout*1000)
+        _io_interest (map)
         pollster = select.poll ()
         R = select.POLLIN | select.POLLPRI
         W = select.POLLOUT
-        RW = R | W
-        concurrent = map.items ()
-        rest = limit - len (concurrent)
-        if rest < 0:
-                concurrent = concurrent[:limit]
+        masks = (0, R, W, R | W)
+        concurrent = _io_window (limit)
+        if timeout == None:
+                if concurrent and len (concurrent) == len (_interests):
+                        timeout = -1
+                else:
+                        timeout = int (precision*1000)
         else:
-                rest = 0
-        for fd, dispatcher in concurrent:
-                if dispatcher.readable ():
-                        if dispatcher.writable ():
-                                pollster.register (fd, RW)
-                        else:
-                                pollster.register (fd, R)
-                elif dispatcher.writable ():
-                        pollster.register (fd, W)
+                timeout = int (math.ceil (timeout*1000))
+        for fd, mask in concurrent:
+                pollster.register (fd, masks[mask])
         try:
                 p = pollster.poll (timeout)
         except select.error, err:
                 if err[0] != errno.EINTR:
                         raise
                         
-        else:
-                for fd, flags in p:
-                        try:
-                                dispatcher = map[fd]
-                        except KeyError:
-                                continue
-        
-                        try:
+                return len (concurrent), 0
+                        
+        if _meters != None:
+                _meters.meters_polled = time.time ()
+        if _priorities:
+                p = _io_prioritize (p)
+        profiled = _profiled
+        if profiled != None:
+                profiled.profile_polled (p)
+        for fd, flags in p:
+                try:
+                        dispatcher = map[fd]
+                except KeyError:
+                        continue
+
+                try:
+                        if profiled != None:
+                                profiled.profile_io (
+                                        dispatcher, flags & R, flags & W
+                                        )
+                        else:
                                 if flags & R:
                                         dispatcher.handle_read_event ()
                                 if flags & W:
                                         dispatcher.handle_write_event ()
-                        except Exit:
-                                raise 
-                                
-                        except:
-                                dispatcher.handle_error()
-        return limit - rest, len (p)
+                except Exit:
+                        raise 
+                        
+                except:
+                        dispatcher.handle_error()
+                _announced.setdefault (fd, dispatcher)
+        return len (concurrent), len (p)
 
 
+# Poll I/O with a persistent epoll registration (Linux 2.6 and later)
+
+_epoll = None
+
+def _io_epoll (map, timeout, limit):
+        "poll for I/O the dispatchers registered with a persistent epoll"
+        global _epoll
+        if _epoll == None:
+                _epoll = select.epoll ()
+        R = select.EPOLLIN | select.EPOLLPRI
+        W = select.EPOLLOUT
+        masks = (0, R, W, R | W)
+        for fd, interest, mask in _io_interest (map):
+                _epoll_control (fd, masks[interest], masks[mask])
+        if timeout == None:
+                if _interests:
+                        timeout = -1
+                else:
+                        timeout = precision
+        else:
+                timeout = (math.ceil (timeout*1000) + 0.5) / 1000
+        try:
+                p = _epoll.poll (timeout, limit)
+        except IOError, err:
+                if err[0] != errno.EINTR:
+                        raise
+                        
+                return len (_interests), 0
+
+        if _meters != None:
+                _meters.meters_polled = time.time ()
+        if _priorities:
+                p = _io_prioritize (p)
+        profiled = _profiled
+        if profiled != None:
+                profiled.profile_polled (p)
+        for fd, flags in p:
+                try:
+                        dispatcher = map[fd]
+                except KeyError:
+                        _io_unregister (fd) # not dispatched anymore
+                        continue
+
+                try:
+                        if profiled != None:
+                                profiled.profile_io (
+                                        dispatcher, flags & R, flags & W
+                                        )
+                        elif flags & W:
+                                if flags & R:
+                                        dispatcher.handle_read_event ()
+                                dispatcher.handle_write_event ()
+                        else:
+                                dispatcher.handle_read_event ()
+                except Exit:
+                        raise 
+                        
+                except:
+                        dispatcher.handle_error()
+                _announced.setdefault (fd, dispatcher)
+        return len (_interests), len (p)
+        #
+        # note that error and hang-up events are handled as read events,
+        # a recv that returns an empty string or raises a socket error 
+        # will then close the dispatcher instead of spinning the loop.
+        #
+        # there is no window to rotate here: all interests are registered 
+        # and the limit caps the number of events returned, the kernel
+        # requeues the ready file descriptors reported after the ones not
+        # reported yet, which is fair enough.
+        #
+        # epoll truncates its timeout to milliseconds, so it is rounded up
+        # here to the next one: waking up before the next event due would
+        # only loop once more to wait for the rest of that millisecond.
+
+def _epoll_control (fd, registered, mask):
+        "register, modify or unregister a file descriptor's interest"
+        try:
+                if mask == 0:
+                        _epoll.unregister (fd)
+                elif registered:
+                        _epoll.modify (fd, mask)
+                else:
+                        _epoll.register (fd, mask)
+        except (IOError, OSError), err:
+                if err[0] == errno.EEXIST:
+                        _epoll.modify (fd, mask)
+                elif err[0] == errno.ENOENT and mask:
+                        _epoll.register (fd, mask)
+                elif not err[0] in (errno.ENOENT, errno.EBADF):
+                        raise
+
+def _io_unregister (fd):
+        "forget the interest polled for a file descriptor"
+        if _priorities:
+                _priorities.pop (fd, None)
+        try:
+                del _interests[fd]
+        except KeyError:
+                return
+        
+        if _io_waits != None:
+                try:
+                        del _io_waits[fd]
+                except KeyError:
+                        pass
+        if _epoll != None:
+                try:
+                        _epoll.unregister (fd)
+                except (IOError, OSError):
+                        pass # closed allready, unregistered by the kernel
+        
+        
 # select the best I/O poll function available for this system
 
-if hasattr (select, 'poll'):
+if hasattr (select, 'epoll'):
+        _io = _io_epoll
+elif hasattr (select, 'poll'):
 	_io = _io_poll
 else:
 	_io = _io_select
+_io_best = _io
+
+
+# Poll Input (a scratch buffer shared by dispatchers)
+
+_scratch = None
+
+def scratch (size):
+        "return the loop's scratch bytearray, of at least size bytes"
+        global _scratch
+        if _scratch == None or len (_scratch) < size:
+                _scratch = bytearray (size)
+        return _scratch
+        #
+        # dispatchers receive into one buffer and keep only what they 
+        # did not consume, so that idle connections hold no buffer.
 
 
 # Poll Memory (Finalizations, ie: CPython __del__ decoupled)
 
 _finalized = collections.deque ()
 
+_finalized_count = 0
+
+_finalized_when = time.time ()
+
+finalize_limit = None
+
+finalize_budget = None
+
 def _finalize ():
-	"call all finalizations queued"
+	"call the finalizations queued, within a limit and a time budget"
+        global _finalized_count
+        if finalize_budget:
+                deadline = time.time () + finalize_budget
+        else:
+                deadline = None
+        count = 0
         while True:
+                if (finalize_limit and count == finalize_limit) or (
+                        deadline != None and time.time () > deadline
+                        ):
+                        break # carry the rest over to the next iteration
+                
                 try:
                         finalized = _finalized.popleft ()
                 except IndexError:
                         break
                        
+                count += 1
+                _finalized_count += 1
                 try:
-                        finalized.finalization = finalized.finalization (
-                               finalized
-                               ) # finalize and maybe continue ...
+                        if _profiled == None:
+                                finalized.finalization = \
+                                        finalized.finalization (finalized)
+                        else:
+                                finalized.finalization = \
+                                        _profiled.profile_call (
+                                                finalized.finalization, 
+                                                finalized, finalized
+                                                )
+                        # finalize and maybe continue ...
                 except Exit:
                         finalized.finalization = None
                         raise
@@ -187,39 +494,595 @@ def _finalize ():
                 except:
                         finalized.finalization = None
                         loginfo.traceback () # log exception
+        #
+        # finalizations left in the queue are called at the next iteration,
+        # after a poll that does not wait for I/O, so that a burst of them
+        # is spread over as many iterations as their limit or budget need.
+        # Like a budget of 0, a limit below 1 does not limit: a limit of 0
+        # would never drain the queue and spin the loop without waiting.
         
 	
 # Poll Time (Scheduled Events)
 
 precision = 0.1
 
-_scheduled = []
+class Scheduled (object):
+        
+        "a cancellable handle on an event scheduled"
+        
+        __slots__ = ('when', 'scheduled', 'scheduler', 'entry')
+        
+        def __init__ (self, scheduler, scheduled):
+                self.scheduler = scheduler
+                self.scheduled = scheduled
+                self.when = self.entry = None
+                
+        def __repr__ (self):
+                return 'scheduled when="%r" %r' % (self.when, self.scheduled)
+                
+        def cancel (self):
+                "cancel the event scheduled and any of its recurrence"
+                if self.entry != None:
+                        self.entry = None
+                        self.scheduler.cancelled ()
+                self.scheduled = None
+                
+        def reschedule (self, when):
+                "move the event scheduled, or schedule it again if fired"
+                if self.scheduled == None:
+                        return # cancelled
+                
+                if self.entry != None:
+                        self.entry = None
+                        self.scheduler.cancelled ()
+                self.scheduler.push (self, when)
+
+
+class Heap (object):
+        
+        "a heap of events scheduled, purged from cancelled events lazily"
+        
+        def __init__ (self):
+                self.heap = []
+                self.heap_dead = 0
+                
+        def __len__ (self):
+                "return the number of events pending in the heap"
+                return len (self.heap) - self.heap_dead
+        
+        def __iter__ (self):
+                "iterate through the events pending, in no order"
+                for entry in self.heap:
+                        if entry[1].entry is entry:
+                                yield entry[1]
+        
+        def push (self, event, when):
+                "push an event in the heap, in O(log N)"
+                event.when = when
+                event.entry = entry = (when, event)
+                heapq.heappush (self.heap, entry)
+                
+        def pop (self, now):
+                "return the events due before now, in order, drop cancelled"
+                due = []
+                heap = self.heap
+                while heap and heap[0][0] <= now:
+                        entry = heapq.heappop (heap)
+                        event = entry[1]
+                        if event.entry is entry:
+                                event.entry = None
+                                due.append (event)
+                        else:
+                                self.heap_dead -= 1
+                return due
+        
+        def deadline (self):
+                "return the time of the next event due, or None"
+                heap = self.heap
+                while heap:
+                        entry = heap[0]
+                        if entry[1].entry is entry:
+                                return entry[0]
+                        
+                        heapq.heappop (heap)
+                        self.heap_dead -= 1
+                return None
+        
+        def cancelled (self):
+                "account a cancelled entry, compact when half are dead"
+                self.heap_dead += 1
+                if self.heap_dead > len (self.heap) / 2:
+                        self.heap = [
+                                entry for entry in self.heap 
+                                if entry[1].entry is entry
+                                ]
+                        heapq.heapify (self.heap)
+                        self.heap_dead = 0
+                #
+                # cancelled entries are dropped when they come due, unless 
+                # they are more than the ones pending, then the heap is
+                # compacted in O(N) instead of growing with dead entries.
+
+        
+class Wheel (object):
+        
+        "a hashed timer wheel of events scheduled, ticking at precision"
+        
+        def __init__ (self, size=4096, precision=precision):
+                self.wheel_size = size
+                self.wheel_precision = precision
+                self.wheel_buckets = [[] for i in xrange (size)]
+                self.wheel_tick = int (time.time () / precision)
+                self.wheel_count = 0
+                self.wheel_deadline = None
+                self.wheel_stale = False
+                
+        def __len__ (self):
+                "return the number of events pending on the wheel"
+                return self.wheel_count
+        
+        def __iter__ (self):
+                "iterate through the events pending, in no order"
+                for bucket in self.wheel_buckets:
+                        for entry in bucket:
+                                if entry[1].entry is entry:
+                                        yield entry[1]
+        
+        def push (self, event, when):
+                "put an event in the bucket of its tick, in O(1)"
+                event.when = when
+                event.entry = entry = (when, event)
+                tick = int (when / self.wheel_precision)
+                if tick < self.wheel_tick:
+                        tick = self.wheel_tick # late, due now
+                self.wheel_buckets[tick % self.wheel_size].append (entry)
+                self.wheel_count += 1
+                if not self.wheel_stale and (
+                        self.wheel_deadline == None or 
+                        when < self.wheel_deadline
+                        ):
+                        self.wheel_deadline = when
+                
+        def pop (self, now):
+                "return the events due before now, in order, drop cancelled"
+                due = []
+                size = self.wheel_size
+                buckets = self.wheel_buckets
+                tick = int (now / self.wheel_precision)
+                ticks = min (tick - self.wheel_tick, size - 1) + 1
+                index = self.wheel_tick
+                for index in xrange (index, index + ticks):
+                        bucket = buckets[index % size]
+                        if not bucket:
+                                continue
+                        
+                        rest = []
+                        for entry in bucket:
+                                event = entry[1]
+                                if event.entry is not entry:
+                                        continue # cancelled
+                                
+                                if entry[0] <= now:
+                                        event.entry = None
+                                        due.append (entry)
+                                        self.wheel_count -= 1
+                                else:
+                                        rest.append (entry)
+                        buckets[index % size] = rest
+                self.wheel_tick = max (tick, self.wheel_tick)
+                if due or (
+                        self.wheel_deadline != None and 
+                        self.wheel_deadline <= now
+                        ):
+                        self.wheel_stale = True
+                due.sort ()
+                return [entry[1] for entry in due]
+                #
+                # the bucket of the current tick is swept again at the next
+                # call because it may hold events due later during that 
+                # tick, and the events more than one revolution away are
+                # swept once per revolution until they are due.
+                
+        def deadline (self):
+                "return the time of the earliest event pending, if any"
+                if not self.wheel_count:
+                        return None
+                
+                if self.wheel_stale:
+                        self.wheel_deadline = self.wheel_earliest ()
+                        self.wheel_stale = False
+                return self.wheel_deadline
+                
+        def wheel_earliest (self):
+                "find the earliest event pending, in the fewest buckets"
+                size = self.wheel_size
+                buckets = self.wheel_buckets
+                precision = self.wheel_precision
+                tick = self.wheel_tick
+                for index in xrange (tick, tick + size):
+                        earliest = [
+                                entry[0] for entry in buckets[index % size]
+                                if entry[1].entry is entry and 
+                                int (entry[0] / precision) <= index
+                                ]
+                        if earliest:
+                                return min (earliest)
+                        
+                earliest = [event.when for event in self]
+                if earliest:
+                        return min (earliest)
+                
+                return None
+                #
+                # the earliest deadline is cached, lowered by each event 
+                # pushed and found again only after events were popped or
+                # it passed: cancelled events may leave it early, so that
+                # the loop wakes up once for nothing, but never late.
+                
+        def cancelled (self):
+                "account a cancelled entry, dropped when its bucket is swept"
+                self.wheel_count -= 1
+
+
+_scheduled = Heap ()
+
+def _io_timeout ():
+        "return the time to wait for I/O before the next event due"
+        if _soon or _finalized:
+                return 0.0
+        
+        deadline = _scheduled.deadline ()
+        if deadline == None:
+                return None # block until an I/O event
+        
+        return max (deadline - time.time (), 0.0)
+        #
+        # instead of ticking at precision, the loop sleeps until the next
+        # event due and fires it as soon as it is, or blocks when nothing
+        # is scheduled nor finalized. A dispatcher's readable or writable
+        # predicate that changes without an I/O event, a scheduled event
+        # or a trigger, is polled again only when one of those happens.
 
 def _clock ():
 	"call all events scheduled before now, maybe recurr in the future"
 	now = time.time ()
         future = now + precision
-	while _scheduled:
-		# get the next defered ...
-		event = heapq.heappop (_scheduled)
-		if event[0] > now:
-			heapq.heappush (_scheduled, event)
-			break  # ... nothing to defer now.
-
+        late = None
+        if _meters != None:
+                late = _meters.meters_late
+        for event in _scheduled.pop (now):
+                scheduled = event.scheduled
+                if scheduled == None or event.entry != None:
+                        continue # cancelled or rescheduled since popped
+                
+                if late != None:
+                        late.add (time.time () - event.when)
 		try:
 			# ... do defer and ...
-			continued = event[1] (event[0])
+                        if _profiled == None:
+                                continued = scheduled (event.when)
+                        else:
+                                continued = _profiled.profile_call (
+                                        scheduled, event, event.when
+                                        )
                 except Exit:
                         raise
                 
 		except:
 			loginfo.traceback ()
 		else:
-			if continued != None:
+			if (
+                                continued != None and 
+                                event.scheduled != None and
+                                event.entry == None
+                                ):
                                 # ... maybe recurr in the future
+                                event.scheduled = continued[1]
                                 if continued[0] < future:
-                                        continued = (future, continued[1])
-				heapq.heappush (_scheduled, continued) 
+                                        _scheduled.push (event, future)
+                                else:
+                                        _scheduled.push (event, continued[0])
+
+
+def wheel (loop, size=4096):
+        "replace the loop's heap of events scheduled with a timer wheel"
+        scheduled = Wheel (size, loop.precision)
+        for event in tuple (loop._scheduled):
+                event.scheduler = scheduled
+                scheduled.push (event, event.when)
+        loop._scheduled = scheduled
+        loginfo.log ('wheel size="%d"' % size, 'info')
+
+
+# Poll Soon (Deferred Calls)
+
+_soon = collections.deque ()
+
+_soon_trigger = None
+
+def _call_soon ():
+        "call the functions deferred before, not the ones they defer"
+        for i in xrange (len (_soon)):
+                function, args = _soon.popleft ()
+                try:
+                        if _profiled == None:
+                                function (*args)
+                        else:
+                                _profiled.profile_call (
+                                        function, function, *args
+                                        )
+                except Exit:
+                        raise
+                
+                except:
+                        loginfo.traceback ()
+
+
+# Poll Garbage (Collection Policy)
+
+_collected = None
+
+def _collect (generation):
+        "collect a generation of garbage, meter its pause if enabled"
+        if _collected == None:
+                return gc.collect (generation)
+        
+        when = time.time ()
+        collected = gc.collect (generation)
+        pause = time.time () - when
+        metered = _collected[generation]
+        metered[0] += 1
+        metered[1] += pause
+        if pause > metered[2]:
+                metered[2] = pause
+        metered[3] += collected
+        return collected
+
+
+class Collector (object):
+        
+        "a garbage collection policy, young when idle, old on schedule"
+        
+        gc_postponed_limit = 10
+        
+        def __init__ (self, loop, interval, budget):
+                self.gc_loop = loop
+                self.gc_interval = interval
+                self.gc_budget = budget
+                self.gc_threshold = gc.get_threshold ()
+                self.gc_pause = 0.0
+                self.gc_full = False
+                self.gc_postponed = 0
+                self.gc_scheduled = None
+                
+        def gc_start (self, when):
+                "schedule the collection of old generations"
+                self.gc_scheduled = self.gc_loop.schedule (
+                        when + self.gc_interval, self.gc_collect
+                        )
+        
+        def gc_idle (self):
+                "collect the young generation or a full one if due"
+                loop = self.gc_loop
+                if self.gc_full:
+                        self.gc_full = False
+                        self.gc_collect_full ()
+                elif gc.get_count ()[0] > 0:
+                        loop._collect (0)
+                if self.gc_scheduled == None and loop._dispatched:
+                        self.gc_start (time.time ())
+        
+        def gc_collect (self, when):
+                "collect the old generations within budget, or stop"
+                loop = self.gc_loop
+                if not (loop._dispatched or loop._scheduled):
+                        self.gc_scheduled = None
+                        self.gc_collect_full ()
+                        return None # nothing left to stall, let it exit
+                
+                if (
+                        self.gc_pause > self.gc_budget and
+                        self.gc_postponed < self.gc_postponed_limit
+                        ):
+                        loop._collect (1)
+                        self.gc_full = True # when idle
+                        self.gc_postponed += 1
+                else:
+                        self.gc_collect_full ()
+                return (when + self.gc_interval, self.gc_collect)
+        
+        def gc_collect_full (self):
+                "collect all generations and account the pause"
+                when = time.time ()
+                self.gc_loop._collect (2)
+                self.gc_pause = time.time () - when
+                self.gc_full = False
+                self.gc_postponed = 0
+
+        #
+        # automatic collections of the old generations are disabled, so
+        # that they happen between I/O and time events instead of in the
+        # middle of one: at each interval, if the last full collection
+        # fitted in the budget, once more, otherwise the middle generation
+        # is collected and the full collection is postponed to the next
+        # poll that returns no I/O event. A server that is never idle 
+        # would never collect its old generation again, so the full
+        # collection is forced after gc_postponed_limit intervals, and 
+        # its pause measured again.
+        #
+        # the exit condition of dispatch collects the young generation
+        # only, the full collection that may finalize old cycles before
+        # the loop stops is done by the collector, when it is scheduled.
+
+_collector = None
+
+
+# Poll Meters (Histograms)
+
+_histogram_limits = [1e-6 * 2 ** (i / 4.0) for i in xrange (120)]
+
+class Histogram (object):
+        
+        "a histogram of durations in fixed buckets, from a microsecond up"
+        
+        def __init__ (self):
+                self.histogram_buckets = [0] * (len (_histogram_limits) + 1)
+                self.histogram_count = 0
+                self.histogram_total = self.histogram_max = 0.0
+                
+        def add (self, seconds):
+                "count a duration in its bucket, in O(log buckets)"
+                self.histogram_buckets[
+                        bisect.bisect_left (_histogram_limits, seconds)
+                        ] += 1
+                self.histogram_count += 1
+                self.histogram_total += seconds
+                if seconds > self.histogram_max:
+                        self.histogram_max = seconds
+                        
+        def percentile (self, percent):
+                "return the upper limit of the bucket of a percentile"
+                rank = self.histogram_count * percent / 100.0
+                counted = 0
+                for index, count in enumerate (self.histogram_buckets):
+                        counted += count
+                        if count and counted >= rank:
+                                if index < len (_histogram_limits):
+                                        return min (
+                                                _histogram_limits[index],
+                                                self.histogram_max
+                                                )
+                                        
+                                break
+                                
+                return self.histogram_max
+        
+        def stats (self):
+                "return (count, mean, p50, p99, p999, max)"
+                if self.histogram_count == 0:
+                        return (0, 0.0, 0.0, 0.0, 0.0, 0.0)
+                
+                return (
+                        self.histogram_count, 
+                        self.histogram_total / self.histogram_count,
+                        self.percentile (50), 
+                        self.percentile (99), 
+                        self.percentile (99.9),
+                        self.histogram_max
+                        )
+        #
+        # the buckets grow by a quarter of an octave, so percentiles are
+        # approximated by less than 19 percent, up to 15 minutes.
+
+
+_meters_phases = ('poll', 'handle', 'clock', 'finalize', 'iteration', 'late')
+
+class Meters (object):
+        
+        "the histograms of a loop's iterations and of its timers lateness"
+        
+        meters_polled = None
+        
+        def __init__ (self):
+                self.meters_poll = Histogram ()
+                self.meters_handle = Histogram ()
+                self.meters_clock = Histogram ()
+                self.meters_finalize = Histogram ()
+                self.meters_iteration = Histogram ()
+                self.meters_late = Histogram ()
+
+_meters = None
+
+
+# Poll Profiles (Handlers Accounting)
+
+def _profile_key (called):
+        try:
+                return called.im_func.func_code
+        
+        except AttributeError:
+                try:
+                        return called.func_code
+                
+                except AttributeError:
+                        return called.__class__
+                        
+def _profile_name (key):
+        if isinstance (key, types.CodeType):
+                return '%s %s:%d' % (
+                        key.co_name, key.co_filename, key.co_firstlineno
+                        )
+        
+        return '%s.%s' % (key.__module__, key.__name__)
+
+
+class Profile (object):
+        
+        "account wall and CPU time per dispatcher class and function"
+        
+        def __init__ (self, threshold):
+                self.profile_threshold = threshold
+                self.profile_accounts = {}
+                
+        def profile_polled (self, events):
+                "pass, called with the (fd, flags) polled, before handling"
+                pass
+                
+        def profile_io (self, dispatcher, read, write):
+                "handle the I/O events of a dispatcher, account the time"
+                wall = time.time ()
+                cpu = time.clock ()
+                try:
+                        if read:
+                                dispatcher.handle_read_event ()
+                        if write:
+                                dispatcher.handle_write_event ()
+                finally:
+                        self.profile_account (
+                                dispatcher.__class__, dispatcher, 
+                                time.time () - wall, time.clock () - cpu
+                                )
+                
+        def profile_call (self, called, instance, *args):
+                "call a scheduled event or finalization, account the time"
+                wall = time.time ()
+                cpu = time.clock ()
+                try:
+                        return called (*args)
+                
+                finally:
+                        self.profile_account (
+                                _profile_key (called), instance,
+                                time.time () - wall, time.clock () - cpu
+                                )
+        
+        def profile_account (self, key, instance, wall, cpu):
+                "account the time of a call, log it if it was too slow"
+                try:
+                        account = self.profile_accounts[key]
+                except KeyError:
+                        account = self.profile_accounts[key] = [
+                                0, 0.0, 0.0, 0.0
+                                ]
+                account[0] += 1
+                account[1] += wall
+                account[2] += cpu
+                if wall > account[3]:
+                        account[3] = wall
+                if wall > self.profile_threshold:
+                        loginfo.log (
+                                '%r seconds="%f" cpu="%f"' % (
+                                        instance, wall, cpu
+                                        ), 'slow'
+                                )
+        #
+        # handlers are accounted per dispatcher class, scheduled events
+        # and finalizations per function - or per class for a callable
+        # instance - so that the accounts are as many as the functions
+        # of the application, not as many as its instances. The CPU time
+        # is the one of the process, as measured by time.clock.
+
+_profiled = None
 
 
 # Poll Signals (Exceptions Handler)
@@ -254,10 +1117,23 @@ def _catched ():
 # Application Programming Interfaces
 
 def schedule (when, scheduled):
-        "schedule a call to scheduled after when"
-        heapq.heappush (_scheduled, (when, scheduled))        
+        "schedule a call to scheduled after when, return a handle"
+        event = Scheduled (_scheduled, scheduled)
+        _scheduled.push (event, when)
+        return event
+        
+
+def call_soon (function, *args):
+        "defer a call to function with args to the next iteration"
+        _soon.append ((function, args))
         
 
+def call_soon_threadsafe (function, *args):
+        "defer a call from another thread, through the loop's trigger"
+        assert _soon_trigger != None, 'trigger (loop) first'
+        _soon_trigger ((function, args))
+
+
 def catch (catcher):
         "register an catcher for the Exit exception"
         _catchers.append (catcher)
@@ -267,13 +1143,29 @@ concurrency = 512
 
 _dispatched = {}
 
+_watchdog = None
+
 def dispatch ():
         "dispatch I/O, time and finalization events"
         assert None == loginfo.log ('async_dispatch_start', 'debug')
-        while _dispatched or _scheduled or _finalized or gc.collect () > 0:
+        while (
+                _dispatched or _scheduled or _soon or _finalized or 
+                _collect (0) > 0
+                ):
+                if _watchdog != None:
+                        _watchdog.watchdog_beat = time.time ()
                 try:
-                        _io (_dispatched, precision, concurrency)
+                        if _meters != None:
+                                _dispatch_metered ()
+                                continue
+                                
+                        concurrent, polled = _io (
+                                _dispatched, _io_timeout (), concurrency
+                                )
+                        if polled == 0 and _collector != None:
+                                _collector.gc_idle ()
                         _clock ()
+                        _call_soon ()
                         _finalize ()
                 except Exit:
                         if not _catched ():
@@ -282,50 +1174,354 @@ def dispatch ():
                 except:
                         loginfo.traceback ()
         
+        if _watchdog != None:
+                _watchdog.watchdog_beat = None
         assert None == loginfo.log ('async_dispatch_stop', 'debug')
+
+def _dispatch_metered ():
+        "dispatch I/O, time and finalization events once, meter each phase"
+        meters = _meters
+        meters.meters_polled = None
+        started = time.time ()
+        concurrent, polled = _io (_dispatched, _io_timeout (), concurrency)
+        handled = time.time ()
+        if polled == 0 and _collector != None:
+                _collector.gc_idle ()
+        _clock ()
+        _call_soon ()
+        clocked = time.time ()
+        _finalize ()
+        finalized = time.time ()
+        waited = meters.meters_polled or handled
+        meters.meters_poll.add (waited - started)
+        meters.meters_handle.add (handled - waited)
+        meters.meters_clock.add (clocked - handled)
+        meters.meters_finalize.add (finalized - clocked)
+        meters.meters_iteration.add (finalized - started)
+        #
+        # the poll wait ends when the I/O backend returns from its system
+        # call, the time left until it returns is spent by I/O handlers,
+        # and the time of idle collections and of deferred calls are
+        # accounted with the clock.
+
+
+# Independent Loops
+
+_loop_functions = (
+        '_io_interest', '_io_window', '_io_waited', '_io_prioritize',
+        '_io_select', '_io_poll', '_io_epoll', '_epoll_control', 
+        '_io_unregister', '_finalize', '_io_timeout', '_clock', 
+        '_collect', '_catched', 'schedule', 'catch', 'dispatch',
+        '_dispatch_metered', '_call_soon', 'call_soon', 
+        'call_soon_threadsafe', 'scratch'
+        )
+
+class Loop (object):
+        
+        "a loop with its own dispatchers, events and finalizations"
+        
+        def __init__ (self, precision=precision, concurrency=concurrency):
+                namespace = self.__dict__
+                namespace.update (globals ())
+                for name in _loop_functions:
+                        function = namespace[name]
+                        namespace[name] = types.FunctionType (
+                                function.func_code, namespace, name,
+                                function.func_defaults
+                                )
+                self.precision = precision
+                self.concurrency = concurrency
+                self._interests = {}
+                self._priorities = {}
+                self._announced = {}
+                self._io_cursor = 0
+                self._io_waits = None
+                self._epoll = None
+                self._io = namespace[_io_best.func_name]
+                self._scratch = None
+                self._finalized = collections.deque ()
+                self._finalized_count = 0
+                self._finalized_when = time.time ()
+                self._scheduled = Heap ()
+                self._catchers = []
+                self._soon = collections.deque ()
+                self._soon_trigger = None
+                self._collected = None
+                self._collector = None
+                self._meters = None
+                self._profiled = None
+                self._dispatched = {}
+                self._watchdog = None
+                
+        def __repr__ (self):
+                return 'async-loop id="%x"' % id (self)
+                
+        #
+        # the loop's functions are the module's, with the instance's
+        # namespace as globals: its attributes mirror the module's, so
+        # that loop.dispatch () or loop.schedule (when, scheduled) run
+        # the same code on its own state, and io_meter (loop), wheel 
+        # (loop) or gc_schedule (loop) apply to a loop as to the module.
+
+
+def forked (loop):
+        "reset the loop's I/O registrations in a forked process"
+        if loop._epoll != None:
+                loop._epoll.close ()
+                loop._epoll = None
+        loop._interests.clear ()
+        loop._announced.update (loop._dispatched)
+        #
+        # a child process shares its parent's epoll registrations, they
+        # must be made again in its own epoll for its own dispatchers.
+        
+
+def bind (loop, instance):
+        "bind a dispatcher, finalization or timeouts instance to a loop"
+        dispatched = hasattr (instance, 'async_map') and (
+                instance.async_map.get (instance._fileno) is instance
+                )
+        if dispatched:
+                instance.del_channel ()
+        instance.async_loop = loop
+        if hasattr (instance, 'async_map'):
+                instance.async_map = loop._dispatched
+                instance.async_announced = loop._announced
+                instance.async_priorities = loop._priorities
+        if hasattr (instance, 'async_finalized'):
+                instance.async_finalized = loop._finalized
+        if dispatched:
+                instance.add_channel ()
+        return instance
+        #
+        # a dispatcher that added itself to the map of its loop in its 
+        # constructor, like a Listen or a Trigger, is moved from that 
+        # map to the new loop's, so that the loop polls and closes it.
    
    
-def io_meter (loop, when=None):
-        "decorate the loop module's I/O poll function with meters, log info"
-        loop._io_when = when or time.time ()
-        loop._io_run = 0
-        loop._io_load = loop._io_concurrency = loop._io_activity = 0.0
-        def _io_metering (map, timeout, limit):
-                loop._io_run += 1
-                dispatched = len (loop._dispatched)
-                concurrent, polled = _io (map, timeout, limit)
-                if concurrent > 0:
-                        loop._io_activity += float (active) / concurrent
-                        concurrent = float (concurrent)
-                        loop._io_load += concurrent / limit
-                        loop._io_concurrency += concurrent / dispatched
-
-        loop._io_metered = loop._io
-        loop._io = _io_metering
+def io_meter (loop):
+        "meter the loop's iterations and timers lateness in histograms"
+        loop._meters = Meters ()
         loginfo.log ('io-metered', 'info')
         
 def io_meters (loop):
-        "return statistics about a metered I/O loop"
-        return (
-                loop._io_when, loop._io_run,
-                loop._io_run / (time.time () - loop._io_when),
-                loop._io_load / loop._io_run,
-                loop._io_concurrency / loop._io_run,
-                loop._io_activity / loop._io_run
-                )
+        "return {phase: (count, mean, p50, p99, p999, max)} in seconds"
+        meters = {}
+        for phase in _meters_phases:
+                meters[phase] = getattr (
+                        loop._meters, 'meters_' + phase
+                        ).stats ()
+        return meters
 
 def io_unmeter (loop):
-        "log meter statistics and remove the metering decoration"
+        "log the statistics of each phase and stop metering"
         meters = io_meters (loop)
+        for phase in _meters_phases:
+                loginfo.log (
+                        'io-unmetered phase="%s" count="%d" mean="%f"'
+                        ' p50="%f" p99="%f" p999="%f" max="%f"' % (
+                                (phase, ) + meters[phase]
+                                ), 'info'
+                        )
+        loop._meters = None
+        return meters
+
+def trigger (loop):
+        "open the loop's select trigger for call_soon_threadsafe"
+        from allegra import select_trigger
+        loop._soon_trigger = bind (loop, select_trigger.Trigger ())
+        
+def untrigger (loop):
+        "close the loop's select trigger"
+        loop._soon_trigger.handle_close ()
+        loop._soon_trigger = None
+        #
+        # the trigger must be opened in the loop's thread, before it
+        # waits for I/O events, and kept open as long as other threads 
+        # may call soon: it keeps the loop running until it is closed.
+
+def finalize_meters (loop):
+        "return the depth of the finalizations queue, drained and rate"
+        return (
+                len (loop._finalized), loop._finalized_count,
+                loop._finalized_count / (time.time () - loop._finalized_when)
+                )
+
+def profile (loop, threshold=0.05):
+        "account handlers time, log the ones slower than threshold"
+        loop._profiled = Profile (threshold)
+        loginfo.log ('profiled threshold="%f"' % threshold, 'info')
+
+def profiles (loop, top=10):
+        "return the top (name, calls, wall, cpu, max) accounts by wall time"
+        profiles = [
+                (_profile_name (key), ) + tuple (account)
+                for key, account in loop._profiled.profile_accounts.items ()
+                ]
+        profiles.sort (key=(lambda profile: profile[2]), reverse=True)
+        return profiles[:top]
+
+def unprofile (loop, top=10):
+        "log the top accounts and stop profiling"
+        profiled = profiles (loop, top)
+        for profile in profiled:
+                loginfo.log (
+                        'unprofiled name="%s" calls="%d"'
+                        ' seconds="%f" cpu="%f" max="%f"' % profile, 'info'
+                        )
+        loop._profiled = None
+        return profiled
+
+def io_wait_meter (loop):
+        "account how long each dispatcher waits to be polled again"
+        loop._io_waits = {}
+        loginfo.log ('io-wait-metered', 'info')
+
+def io_wait_meters (loop):
+        "return (dispatcher, polled, mean, max) wait statistics, worst first"
+        meters = []
+        for fd, waited in loop._io_waits.items ():
+                try:
+                        dispatcher = loop._dispatched[fd]
+                except KeyError:
+                        continue
+                
+                if waited[1] > 0:
+                        meters.append ((
+                                dispatcher, waited[1], 
+                                waited[2] / waited[1], waited[3]
+                                ))
+                else:
+                        meters.append ((dispatcher, 0, 0.0, 0.0))
+        meters.sort (key=(lambda meter: meter[3]), reverse=True)
+        return meters
+
+def io_wait_unmeter (loop):
+        "log the worst wait statistics and stop accounting waits"
+        meters = io_wait_meters (loop)
+        if meters:
+                loginfo.log (
+                        'io-wait-unmetered'
+                        ' dispatchers="%d" polled="%d"'
+                        ' mean="%f" max="%f"' % (
+                                (len (meters), ) + meters[0][1:]
+                                ), 'info'
+                        )
+        loop._io_waits = None
+
+def gc_schedule (loop, interval=1.0, budget=0.005):
+        "collect old garbage on schedule within budget, young when idle"
+        loop._collector = collector = Collector (loop, interval, budget)
+        gc.set_threshold (collector.gc_threshold[0], 1<<30, 1<<30)
+        collector.gc_start (time.time ())
         loginfo.log (
-                'io-unmetered'
-                ' seconds="%f" run="%d"'
-                ' rps="%f" load="%f"'
-                ' concurrency="%f" activity="%f"' % meters, 'info'
+                'gc-scheduled interval="%f" budget="%f"' % (
+                        interval, budget
+                        ), 'info'
+                )
+
+def gc_unschedule (loop):
+        "cancel the scheduled collections, restore automatic ones"
+        collector = loop._collector
+        loop._collector = None
+        if collector.gc_scheduled != None:
+                collector.gc_scheduled.cancel ()
+        gc.set_threshold (*collector.gc_threshold)
+        loginfo.log ('gc-unscheduled', 'info')
+
+def gc_meter (loop):
+        "account the pauses of the loop's garbage collections"
+        loop._collected = dict ([(g, [0, 0.0, 0.0, 0]) for g in (0, 1, 2)])
+        loginfo.log ('gc-metered', 'info')
+
+def gc_meters (loop):
+        "return (generation, count, mean, max, collected) pause statistics"
+        meters = []
+        for generation, metered in loop._collected.items ():
+                if metered[0] > 0:
+                        meters.append ((
+                                generation, metered[0], 
+                                metered[1] / metered[0], metered[2],
+                                metered[3]
+                                ))
+                else:
+                        meters.append ((generation, 0, 0.0, 0.0, 0))
+        meters.sort ()
+        return meters
+
+def gc_unmeter (loop):
+        "log the pause statistics and stop accounting them"
+        meters = gc_meters (loop)
+        for meter in meters:
+                loginfo.log (
+                        'gc-unmetered generation="%d" count="%d"'
+                        ' mean="%f" max="%f" collected="%d"' % meter, 'info'
+                        )
+        loop._collected = None
+        return meters
+
+if __name__ == '__main__':
+        import sys, random
+        assert None == sys.stderr.write (
+                'Allegra Async Loop'
+                ' - Copyright 2005 Laurent A.V. Szyster'
+                ' | Copyleft GPL 2.0\n\n'
                 )
-        del (
-                loop._io_when, loop._io_run, 
-                loop._io_load, _io_concurrency, loop._io_activity
+        # benchmark the heap and the wheel with 10^4 to 10^6 timers spread
+        # over a minute, half of them cancelled, on a simulated clock.
+        class _Simulated_clock (object):
+                
+                now = 0.0
+                
+                def time (self):
+                        return self.now
+
+        clocked = time.time
+        time = _Simulated_clock ()
+        def fired (when):
+                return None
+        
+        def benchmark (scheduler, count, span=60.0):
+                global _scheduled
+                time.now = 0.0
+                if scheduler == 'wheel':
+                        _scheduled = Wheel (4096, precision)
+                else:
+                        _scheduled = Heap ()
+                random.seed (count)
+                whens = [random.random () * span for i in xrange (count)]
+                t = clocked ()
+                handles = [schedule (when, fired) for when in whens]
+                scheduling = clocked () - t
+                t = clocked ()
+                for handle in handles[::2]:
+                        handle.cancel ()
+                cancelling = clocked () - t
+                del handles
+                t = clocked ()
+                while time.now < span + precision:
+                        time.now += precision
+                        _clock ()
+                clocking = clocked () - t
+                assert len (_scheduled) == 0
+                return scheduling, cancelling, clocking
+                
+        if len (sys.argv) > 1:
+                counts = [int (arg) for arg in sys.argv[1:]]
+        else:
+                counts = [10**4, 10**5, 10**6]
+        sys.stderr.write (
+                'scheduler     timers  schedule/s    cancel/s     clock/s\n'
                 )
-        loop._io = loop._io_metered
-        return meters
\ No newline at end of file
+        for count in counts:
+                for scheduler in ('heap', 'wheel'):
+                        scheduling, cancelling, clocking = benchmark (
+                                scheduler, count
+                                )
+                        sys.stderr.write ('%-9s %10d %11d %11d %11d\n' % (
+                                scheduler, count, 
+                                count / scheduling,
+                                (count / 2) / cancelling,
+                                count / clocking
+                                ))
+        sys.exit (0)
\ No newline at end of file
@@ -32,15 +32,15 @@ def collect_net (next, buffer, collect, terminate):
                         collect (buffer)
                         return next - lb, '', False # buffer more ...
 
-                if buffer[next] == ',':
-                        collect (buffer[:next])
+                if buffer[next-1] == ',':
+                        collect (buffer[:next-1])
                         if terminate (None):
-                                return 0, buffer[next+1:], True # stop now!
+                                return 0, buffer[next:], True # stop now!
                         
                 else:
                         raise NetstringError, '3 missing comma'
                 
-                prev = next + 1
+                prev = next
         else:
                 prev = 0
         while prev < lb:
@@ -60,7 +60,7 @@ def collect_net (next, buffer, collect, terminate):
                         
                 if next >= lb:
                         collect (buffer[pos+1:])
-                        return next - lb, '', False # buffer more
+                        return next - lb + 1, '', False # buffer more
                 
                 elif buffer[next] == ',':
                         if terminate (buffer[pos+1:next]):
@@ -73,10 +73,14 @@ def collect_net (next, buffer, collect, terminate):
         return 0, '', False # buffer consumed.
 
 
-class Dispatcher (async_core.Dispatcher):
+class Dispatcher_base (async_core.Dispatcher_base):
+
+        __slots__ = ()
 
         ac_in_buffer_size = ac_out_buffer_size = 1 << 14 # sweet 16 kilobytes
 
+        ac_out_offset = 0
+
         terminator = 0
         collector_stalled = False
                 
@@ -121,32 +125,71 @@ class Dispatcher (async_core.Dispatcher):
                         self.async_net_error (error)
 
         def handle_write (self):
-                "buffer out a fifo of strings, try to send or close if done"
+                "gather a fifo of strings, try to send or close if done"
                 obs = self.ac_out_buffer_size
-                buffer = self.ac_out_buffer
-                fifo = self.output_fifo
-                while len (buffer) < obs and fifo:
-                        strings = fifo.popleft ()
-                        if strings == None:
-                                if buffer == '':
-                                        self.handle_close ()
-                                        return
-                                
-                                else:
-                                        fifo.append (None)
-                                        break
-        
-                        buffer += ''.join ((
-                                '%d:%s,' % (len (s), s) for s in strings
-                                ))
-                if buffer:
-                        sent = self.send (buffer[:obs])
-                        if sent:
-                                self.ac_out_buffer = buffer[sent:]
+                out = self.ac_out_buffer
+                offset = self.ac_out_offset
+                size = len (out) - offset
+                if size < obs:
+                        if size > 0:
+                                gathered = [out[offset:]]
                         else:
-                                self.ac_out_buffer = buffer
-                else:
-                        self.ac_out_buffer = ''
+                                gathered = []
+                        fifo = self.output_fifo
+                        while size < obs and fifo:
+                                strings = fifo.popleft ()
+                                if strings == None:
+                                        if size == 0:
+                                                self.handle_close ()
+                                                return
+                                        
+                                        else:
+                                                fifo.append (None)
+                                                break
+                
+                                if type (strings) == str:
+                                        if size > 0 and size + len (
+                                                strings
+                                                ) > obs:
+                                                fifo.appendleft (strings)
+                                                break # send it alone next
+                                        
+                                        gathered.append (strings)
+                                        size += len (strings)
+                                        continue
+                                
+                                strings = iter (strings)
+                                for s in strings:
+                                        head = '%d:' % len (s)
+                                        gathered.append (head)
+                                        size += len (head)
+                                        if len (s) >= obs:
+                                                fifo.appendleft (strings)
+                                                fifo.appendleft (',')
+                                                fifo.appendleft (s)
+                                                break
+                                        
+                                        gathered.append (s)
+                                        gathered.append (',')
+                                        size += len (s) + 1
+                        out = ''.join (gathered)
+                        offset = 0
+                if out:
+                        offset += self.send (buffer (out, offset, obs))
+                        if offset < len (out):
+                                self.ac_out_buffer = out
+                                self.ac_out_offset = offset
+                                return
+                        
+                self.ac_out_buffer = ''
+                self.ac_out_offset = 0
+                #
+                # netstrings smaller than the output buffer are framed and
+                # gathered in one string. A larger one is split: its length
+                # prefix ends the strings gathered, then its payload is sent
+                # alone and without a copy, followed by its comma and the
+                # rest of its strings. They are queued back in the fifo as 
+                # 8-bit byte strings, which are output as they are.
 
         # A compatible interface with Async_chat.close_when_done used by
         # Allegra's TCP clients and servers implementation.
@@ -156,6 +199,7 @@ class Dispatcher (async_core.Dispatcher):
                 been sent, or close now if the queue is empty."""
                 if self.output_fifo:
                         self.output_fifo.append (None)
+                        self.async_interest ()
                 else:
                         self.handle_close ()
 
@@ -166,14 +210,17 @@ class Dispatcher (async_core.Dispatcher):
                 self.ac_out_buffer += ''.join ((
                         '%d:%s,' % (len (s), s) for s in strings
                         ))
+                self.async_interest ()
 
         def async_net_push (self, strings):
                 "push an iterable of 8-bit byte strings for output"
                 assert hasattr (strings, '__iter__')
                 self.output_fifo.append (strings)
+                self.async_interest ()
 
         def async_net_pull (self):
                 "try to consume the input netstrings buffered"
+                self.async_interest ()
                 if not self.ac_in_buffer:
                         self.collector_stalled = False
                         return
@@ -214,5 +261,26 @@ class Dispatcher (async_core.Dispatcher):
                 "log netstrings error and close the channel"
                 self.log (message, 'async-net-error')
                 self.handle_close ()
+
+
+class Dispatcher (Dispatcher_base, async_core.Dispatcher): pass
+
+
+class Dispatcher_with_slots (
+        Dispatcher_base, async_core.Dispatcher_with_slots
+        ):
+
+        __slots__ = (
+                'ac_in_buffer', 'ac_out_buffer', 'ac_out_offset', 
+                'output_fifo', 'terminator', 'collector_stalled',
+                'async_net_in'
+                )
+
+        def __init__ (self):
+                async_core.Dispatcher_with_slots.__init__ (self)
+                Dispatcher_base.__init__ (self)
+                self.ac_out_offset = self.terminator = 0
+                self.collector_stalled = False
+                self.async_net_in = ''
                 
                 
\ No newline at end of file
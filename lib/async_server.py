@@ -17,20 +17,36 @@
 
 "http://laurentszyster.be/blog/async_server/"
 
-import socket, time
+import socket, time, sys
 
 try:
         SOCKET_FAMILIES = (socket.AF_INET, socket.AF_UNIX)
 except:
         SOCKET_FAMILIES = (socket.AF_INET, )
 
+try:
+        SO_REUSEPORT = socket.SO_REUSEPORT
+except AttributeError:
+        if sys.platform.startswith ('linux'):
+                SO_REUSEPORT = 15 # since Linux 3.9
+        else:
+                SO_REUSEPORT = None
+
 from allegra import async_loop, async_core, async_limits
 
 
 class Listen (async_core.Dispatcher):
         
+        async_announce = True
+        async_priority = 1
+        
         server_when = 0.0
         ac_in_meter = ac_out_meter = server_dispatched = 0
+        server_scheduled = None
+        server_reuse_port = False
+        server_accept_batch = 64
+        server_accepts = server_accept_full = 0
+        server_socket_options = ()
         
         def __init__ (
                 self, Dispatcher, addr, precision, max, 
@@ -47,6 +63,10 @@ class Listen (async_core.Dispatcher):
                 self.server_precision = precision
                 self.create_socket (family, socket.SOCK_STREAM)
                 self.set_reuse_addr ()
+                if self.server_reuse_port:
+                        self.socket.setsockopt (
+                                socket.SOL_SOCKET, SO_REUSEPORT, 1
+                                )
                 self.bind (addr)
                 self.listen (max)
                 anonymous (self)
@@ -64,34 +84,54 @@ class Listen (async_core.Dispatcher):
                 return False
 
         def handle_accept (self):
-                try:
-                        conn, addr = self.accept ()
-                except socket.error:
-                        assert None == self.log (
-                                'accept-bogus-socket', 'error'
-                                )
-                        return
-                        #
-                        # Medusa original comments from Sam Rushing:
-                        #
-                        # linux: on rare occasions we get a bogus socket back 
-                        # from accept. socketmodule.c:makesockaddr complains 
-                        # that the address family is unknown. We don't want 
-                        # the whole server to shut down because of this.
+                "accept a batch of the connections queued"
+                for i in xrange (self.server_accept_batch):
+                        if not self.accepting:
+                                return # shutdown or closed meanwhile
+                        
+                        try:
+                                conn, addr = self.accept ()
+                        except socket.error, error:
+                                if error.errno != None:
+                                        assert None == self.log (
+                                                'accept-error errno="%d"' % 
+                                                error.errno, 'error'
+                                                )
+                                        return # out of descriptors, ...
+                                
+                                assert None == self.log (
+                                        'accept-bogus-socket', 'error'
+                                        )
+                                continue
+                        
+                        except TypeError:
+                                return # the queue is empty
+                        
+                        self.server_accepts += 1
+                        self.server_handle_accept (conn, addr)
+                self.server_accept_full += 1
+                #
+                # draining the queue up to a batch of connections at each
+                # event instead of one, so that a storm of connections does
+                # not overflow the listen backlog. A full batch may have 
+                # left connections queued. An accept that fails with an 
+                # errno - EMFILE, ENFILE, ENOBUFS, ... - ends the batch:
+                # the next ones would fail the same way.
+                #
+                # Medusa original comments from Sam Rushing:
+                #
+                # linux: on rare occasions we get a bogus socket back 
+                # from accept. socketmodule.c:makesockaddr complains 
+                # that the address family is unknown. We don't want 
+                # the whole server to shut down because of this.
+                #
+                # unpack non-sequence.  this can happen when a read 
+                # event fires on a listening socket, but when we call 
+                # accept() we get EWOULDBLOCK, so dispatcher.accept() 
+                # returns None. Seen on FreeBSD3.
                 
-                except TypeError:
-                        assert None == self.log (
-                                'accept-would-block', 'error'
-                                )
-                        return
-                        #
-                        # Medusa original comments from Sam Rushing:
-                        #
-                        # unpack non-sequence.  this can happen when a read 
-                        # event fires on a listening socket, but when we call 
-                        # accept() we get EWOULDBLOCK, so dispatcher.accept() 
-                        # returns None. Seen on FreeBSD3.
-
+        def server_handle_accept (self, conn, addr):
+                "resolve an accepted connection, accept or close it"
                 name = self.server_resolved (addr)
                 if name != None:
                         try:
@@ -152,6 +192,12 @@ class Listen (async_core.Dispatcher):
                 assert None == self.log ('accepted %r' % (addr,), 'debug')
                 now = time.time ()
                 dispatcher = self.Server_dispatcher ()
+                if self.async_loop is not async_loop:
+                        async_loop.bind (self.async_loop, dispatcher)
+                if self.server_socket_options:
+                        async_core.socket_tune (
+                                conn, self.server_socket_options
+                                )
                 dispatcher.set_connection (conn, addr)
                 dispatcher.server_name = name
                 dispatcher.server_when = now
@@ -165,7 +211,7 @@ class Listen (async_core.Dispatcher):
         def server_start (self, when):
                 "handle the client management startup"
                 self.server_when = when
-                async_loop.schedule (
+                self.server_scheduled = self.async_loop.schedule (
                         when + self.server_precision, self.server_manage
                         )
                 assert None == self.log ('start', 'debug')
@@ -223,6 +269,9 @@ class Listen (async_core.Dispatcher):
                                         self.ac_in_meter,
                                         self.ac_out_meter
                                         ), 'info')
+                if self.server_scheduled != None:
+                        self.server_scheduled.cancel ()
+                        self.server_scheduled = None
                 self.server_when = 0.0
                 self.server_dispatched = \
                         self.ac_in_meter = self.ac_out_meter = 0
@@ -232,6 +281,7 @@ class Listen (async_core.Dispatcher):
                 self.log ('shutdown', 'info')
                 if self.server_when:
                         self.accepting = False
+                        self.async_interest ()
                         for dispatcher in tuple (self.server_dispatchers):
                                 dispatcher.close_when_done ()
                 else:
@@ -268,16 +318,67 @@ def accept_named (listen, limit):
         return listen
 
 
+def accept_meters (listen):
+        "return (accepts, accepts per second, full batches) since start"
+        if listen.server_when:
+                rate = listen.server_accepts / (
+                        time.time () - listen.server_when
+                        )
+        else:
+                rate = 0.0
+        return (listen.server_accepts, rate, listen.server_accept_full)
+
+def listen_drops ():
+        "return the host's (overflows, drops) of listen backlogs, or None"
+        try:
+                lines = open ('/proc/net/netstat').read ().split ('\n')
+        except IOError:
+                return None # not Linux
+        
+        for names, values in zip (lines[0::2], lines[1::2]):
+                if names.startswith ('TcpExt:'):
+                        counters = dict (zip (
+                                names.split ()[1:], values.split ()[1:]
+                                ))
+                        return (
+                                int (counters['ListenOverflows']), 
+                                int (counters['ListenDrops'])
+                                )
+                        
+        return None
+        #
+        # the kernel counts the connections dropped when a backlog is 
+        # full for all listeners of the host, not for each one. Compare 
+        # them before and after a storm, along with the full batches.
+
+
+def tuned (listen, *profiles):
+        "tune the listening and accepted sockets, log the values set"
+        options = async_core.socket_options (profiles)
+        async_core.socket_tune (listen.socket, options)
+        listen.server_socket_options = options
+        listen.log ('tuned %s' % async_core.socket_tuned (
+                listen.socket, options
+                ), 'info')
+        return listen
+        #
+        # the options are set on the listening socket first, where Linux 
+        # expects TCP_DEFER_ACCEPT and from which it inherits most of the
+        # others, then on each socket accepted for the platforms that do
+        # not inherit them all.
+
+
 def meter (dispatcher, when):
         "decorate a server dispatcher with stream meters"
         async_limits.meter_recv (dispatcher, when)
         async_limits.meter_send (dispatcher, when)
+        if dispatcher.ac_metered:
+                return # closes and accounts its meters itself
+                
         def close ():
-                del (
-                        dispatcher.recv, 
-                        dispatcher.send, 
-                        dispatcher.close
-                        )
+                async_limits.unmeter_recv (dispatcher)
+                async_limits.unmeter_send (dispatcher)
+                del dispatcher.close
                 dispatcher.close ()
                 dispatcher.async_server.server_close (dispatcher)
                 
@@ -327,9 +428,9 @@ def limited (listen, timeout, inBps, outBps):
                         dispatcher, when, listen.ac_out_throttle_Bps
                         )
                 def close ():
+                        async_limits.unmeter_recv (dispatcher)
+                        async_limits.unmeter_send (dispatcher)
                         del (
-                                dispatcher.recv, 
-                                dispatcher.send, 
                                 dispatcher.readable,
                                 dispatcher.writable,
                                 dispatcher.close
@@ -0,0 +1,236 @@
+# Copyright (C) 2005 Laurent A.V. Szyster
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+#    http://www.gnu.org/copyleft/gpl.html
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+
+"http://laurentszyster.be/blog/asyncio_loop/"
+
+import time, socket
+
+try:
+        import asyncio
+except ImportError:
+        import trollius as asyncio # the Python 2 backport
+
+from allegra import async_loop, async_client
+
+
+class Driver (object):
+        
+        "drive an allegra loop's dispatchers and events from asyncio"
+        
+        asyncio_timer = None
+        asyncio_syncing = False
+        
+        def __init__ (self, loop=async_loop, asyncio_loop=None):
+                self.async_loop = loop
+                self.asyncio_loop = asyncio_loop or asyncio.get_event_loop ()
+                self.asyncio_registered = {}
+                
+        def __repr__ (self):
+                return 'asyncio-driver id="%x"' % id (self)
+        
+        def asyncio_start (self):
+                "register the loop's dispatchers and events with asyncio"
+                loop = self.async_loop
+                self.async_unregister = loop._io_unregister
+                loop._io_unregister = self.asyncio_unregister
+                self.async_schedule = loop.schedule
+                loop.schedule = self.asyncio_schedule
+                self.async_call_soon = loop.call_soon
+                loop.call_soon = self.asyncio_call_soon
+                async_loop.forked (loop)
+                self.asyncio_sync ()
+                #
+                # the interests registered by a previous dispatch () are
+                # forgotten and its epoll closed, so that all dispatchers
+                # are announced again and registered with asyncio instead.
+                
+        def asyncio_stop (self):
+                "unregister all from asyncio, restore the loop"
+                for fd in self.asyncio_registered.keys ():
+                        self.asyncio_control (fd, 0)
+                if self.asyncio_timer != None:
+                        self.asyncio_timer.cancel ()
+                        self.asyncio_timer = None
+                loop = self.async_loop
+                loop._io_unregister = self.async_unregister
+                loop.schedule = self.async_schedule
+                loop.call_soon = self.async_call_soon
+                async_loop.forked (loop)
+                
+        def asyncio_sync (self):
+                "call events due, deferred and finalized, then register"
+                self.asyncio_syncing = True
+                loop = self.async_loop
+                try:
+                        loop._clock ()
+                        loop._call_soon ()
+                        loop._finalize ()
+                        for fd, interest, mask in loop._io_interest (
+                                loop._dispatched
+                                ):
+                                self.asyncio_control (fd, mask)
+                finally:
+                        self.asyncio_syncing = False
+                if loop._soon or loop._finalized:
+                        self.asyncio_synchronize ()
+                deadline = loop._scheduled.deadline ()
+                if self.asyncio_timer != None:
+                        self.asyncio_timer.cancel ()
+                        self.asyncio_timer = None
+                if deadline != None:
+                        aloop = self.asyncio_loop
+                        self.asyncio_timer = aloop.call_at (
+                                aloop.time () + max (
+                                        deadline - time.time (), 0.0
+                                        ),
+                                self.asyncio_sync
+                                )
+        
+        def asyncio_synchronize (self):
+                "synchronize the loop once at the next asyncio iteration"
+                if not self.asyncio_syncing:
+                        self.asyncio_syncing = True
+                        self.asyncio_loop.call_soon (self.asyncio_sync)
+                        
+        def asyncio_schedule (self, when, scheduled):
+                "schedule an event, synchronize the loop to clock it"
+                self.asyncio_synchronize ()
+                return self.async_schedule (when, scheduled)
+                
+        def asyncio_call_soon (self, function, *args):
+                "defer a call, synchronize the loop to make it"
+                self.asyncio_synchronize ()
+                self.async_call_soon (function, *args)
+                        
+        def asyncio_control (self, fd, mask):
+                "add or remove the asyncio reader and writer of an fd"
+                aloop = self.asyncio_loop
+                registered = self.asyncio_registered.get (fd, 0)
+                if mask & 1 and not registered & 1:
+                        aloop.add_reader (fd, self.asyncio_read, fd)
+                elif registered & 1 and not mask & 1:
+                        aloop.remove_reader (fd)
+                if mask & 2 and not registered & 2:
+                        aloop.add_writer (fd, self.asyncio_write, fd)
+                elif registered & 2 and not mask & 2:
+                        aloop.remove_writer (fd)
+                if mask:
+                        self.asyncio_registered[fd] = mask
+                else:
+                        self.asyncio_registered.pop (fd, None)
+        
+        def asyncio_unregister (self, fd):
+                "forget a dispatcher's interest, in the loop and in asyncio"
+                self.async_unregister (fd)
+                if self.asyncio_registered.has_key (fd):
+                        self.asyncio_control (fd, 0)
+                        
+        def asyncio_read (self, fd):
+                self.asyncio_handle (fd, 'handle_read_event')
+                
+        def asyncio_write (self, fd):
+                self.asyncio_handle (fd, 'handle_write_event')
+                
+        def asyncio_handle (self, fd, handler):
+                "handle an I/O event, synchronize the loop after"
+                loop = self.async_loop
+                try:
+                        dispatcher = loop._dispatched[fd]
+                except KeyError:
+                        self.asyncio_control (fd, 0)
+                        return
+                
+                self.asyncio_synchronize ()
+                try:
+                        try:
+                                getattr (dispatcher, handler) ()
+                        except async_loop.Exit:
+                                raise
+                                
+                        except:
+                                dispatcher.handle_error ()
+                finally:
+                        loop._announced.setdefault (fd, dispatcher)
+        #
+        # the loop's interests are registered incrementally, as readers
+        # and writers added or removed when they change, and its events
+        # scheduled are clocked by one asyncio timer set at the earliest
+        # deadline, so that asyncio waits for both and nothing polls.
+        #
+        # the loop's schedule and call_soon are hooked to synchronize it
+        # when a coroutine schedules or defers, but a coroutine that adds
+        # a dispatcher or changes its interest - connects or pushes out - 
+        # must synchronize the driver itself, as connect does.
+
+
+def connect (
+        driver, dispatcher, addr, timeout=3.0, family=socket.AF_INET
+        ):
+        "connect a dispatcher driven from asyncio, return a future"
+        future = asyncio.Future (loop=driver.asyncio_loop)
+        handle_connect = dispatcher.handle_connect
+        handle_close = dispatcher.handle_close
+        def connected ():
+                del dispatcher.handle_connect, dispatcher.handle_close
+                handle_connect ()
+                if not future.done ():
+                        future.set_result (dispatcher)
+                
+        def closed ():
+                del dispatcher.handle_connect, dispatcher.handle_close
+                if not future.done ():
+                        future.set_exception (socket.error (
+                                'not connected to %r' % (addr, )
+                                ))
+                handle_close ()
+                
+        dispatcher.handle_connect = connected
+        dispatcher.handle_close = closed
+        if async_client.connect (dispatcher, addr, timeout, family):
+                driver.asyncio_synchronize ()
+        else:
+                closed ()
+        return future
+        #
+        # the future is resolved with the dispatcher when it connects or 
+        # fails with a socket error when it is closed before, by a connect
+        # timeout or an error, so that a coroutine can wait for it.
+        
+
+# Note about this implementation
+#
+# A Driver runs an allegra loop - the module's default one or a Loop 
+# instance - inside an asyncio loop, instead of its own dispatch (): 
+# asyncio waits for the readers and writers registered for dispatchers,
+# then calls their handlers, and synchronizes the allegra loop after 
+# each of them. A synchronization clocks the events scheduled, calls 
+# the deferred ones, finalizes, and updates the registered interests.
+#
+#        driver = asyncio_loop.Driver ()
+#        driver.asyncio_start ()
+#        asyncio.get_event_loop ().run_forever ()
+#
+# A coroutine connects a dispatcher through its driver, and waits for
+# the future of its connection (with trollius, From is imported from it):
+#
+#        dispatcher = yield From (asyncio_loop.connect (
+#                driver, dispatcher, addr
+#                ))
+#
+# Dispatchers that do not announce their interest are predicated again 
+# at each synchronization, as they are at each iteration of dispatch ().
\ No newline at end of file
@@ -0,0 +1,652 @@
+# Copyright (C) 2005 Laurent A.V. Szyster
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+#    http://www.gnu.org/copyleft/gpl.html
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"http://laurentszyster.be/blog/benchmark/"
+
+import sys, os, time, socket, random, resource, threading
+
+from allegra import (
+        netstring, loginfo, async_loop, finalization, 
+        async_core, async_chat, async_net, async_server, async_client, 
+        async_datagram, async_limits, select_trigger
+        )
+
+
+# Measures
+
+def rss ():
+        "return the resident set size of this process, in bytes"
+        try:
+                return int (
+                        open ('/proc/self/statm').read ().split ()[1]
+                        ) * resource.getpagesize ()
+        
+        except (IOError, IndexError, ValueError):
+                return resource.getrusage (
+                        resource.RUSAGE_SELF
+                        ).ru_maxrss * 1024
+
+def percentiles (name, histogram):
+        "return the (metric, value) of a histogram's percentiles, in seconds"
+        count, mean, p50, p99, p999, max = histogram.stats ()
+        return [
+                (name + '-mean', mean), (name + '-p50', p50),
+                (name + '-p99', p99), (name + '-p999', p999),
+                (name + '-max', max)
+                ]
+                
+def phases ():
+        "return the percentiles of the loop's poll and iteration meters"
+        metered = []
+        for phase in ('poll', 'iteration'):
+                metered.extend (percentiles (
+                        phase, getattr (async_loop._meters, 'meters_' + phase)
+                        ))
+        return metered
+        
+def descriptors (count):
+        "raise the soft limit of file descriptors as near count as possible"
+        soft, hard = resource.getrlimit (resource.RLIMIT_NOFILE)
+        if soft < count:
+                if hard == resource.RLIM_INFINITY or hard > count:
+                        soft = count
+                else:
+                        soft = hard
+                try:
+                        resource.setrlimit (
+                                resource.RLIMIT_NOFILE, (soft, hard)
+                                )
+                except (ValueError, resource.error):
+                        soft = resource.getrlimit (resource.RLIMIT_NOFILE)[0]
+        return soft
+
+
+# Echo and Ping
+
+class Echo (async_chat.Dispatcher):
+        
+        "echo each line back to its peer"
+        
+        async_announce = True
+        
+        def __init__ (self):
+                async_chat.Dispatcher.__init__ (self)
+                self.set_terminator ('\n')
+                self.echo_buffer = []
+                
+        def collect_incoming_data (self, data):
+                self.echo_buffer.append (data)
+                
+        def found_terminator (self):
+                if self.closing:
+                        return True
+                        
+                self.echo_buffer.append ('\n')
+                self.async_chat_push (''.join (self.echo_buffer))
+                self.echo_buffer = []
+                return False
+                
+
+class Ping (async_chat.Dispatcher):
+        
+        "send lines one at a time, account the round-trip of each echo"
+        
+        async_announce = True
+        
+        def __init__ (self, line, count, histogram, done):
+                async_chat.Dispatcher.__init__ (self)
+                self.set_terminator ('\n')
+                self.ping_line = line
+                self.ping_count = count
+                self.ping_histogram = histogram
+                self.ping_done = done
+                
+        def handle_connect (self):
+                self.ping ()
+                
+        def ping (self):
+                self.ping_when = time.time ()
+                self.async_chat_push (self.ping_line)
+                
+        def collect_incoming_data (self, data):
+                pass
+                
+        def found_terminator (self):
+                if self.closing or self.ping_count == 0:
+                        return True
+                
+                self.ping_histogram.add (time.time () - self.ping_when)
+                self.ping_count -= 1
+                if self.ping_count > 0:
+                        self.ping ()
+                else:
+                        self.ping_done (self)
+                return False
+                
+
+class Chatted (async_chat.Dispatcher):
+        
+        "collect lines, report each one"
+        
+        async_announce = True
+        
+        def __init__ (self, done):
+                async_chat.Dispatcher.__init__ (self)
+                self.set_terminator ('\n')
+                self.chatted_done = done
+                
+        def collect_incoming_data (self, data):
+                pass
+                
+        def found_terminator (self):
+                if self.closing:
+                        return True
+                        
+                self.chatted_done (self)
+                return False
+                
+
+class Idle (async_core.Dispatcher):
+        
+        "an idle connection, readable only"
+        
+        async_announce = True
+        
+        def readable (self):
+                return True
+                
+        def writable (self):
+                return False
+                
+        def handle_read (self):
+                self.recv (4096)
+                
+
+class Idle_with_slots (async_core.Dispatcher_with_slots):
+        
+        "an idle connection, readable only and without a dictionary"
+        
+        __slots__ = ()
+        
+        async_announce = True
+        
+        def readable (self):
+                return True
+                
+        def writable (self):
+                return False
+                
+        def handle_read (self):
+                self.recv (4096)
+                
+
+class Sink (async_datagram.Dispatcher):
+        
+        "count the datagrams received, until all are"
+        
+        sink_received = 0
+        sink_when = 0.0
+        
+        def __init__ (self, count, done):
+                async_datagram.Dispatcher.__init__ (self)
+                self.sink_count = count
+                self.sink_done = done
+                
+        def async_datagram_continue (self, data, peer):
+                self.sink_received += 1
+                self.sink_when = time.time ()
+                if self.sink_received == self.sink_count:
+                        self.sink_done ()
+
+
+class Source (async_datagram.Dispatcher):
+        
+        "send the datagrams queued, until none are left"
+        
+        def __init__ (self, done):
+                async_datagram.Dispatcher.__init__ (self)
+                self.source_done = done
+                
+        def handle_write (self):
+                async_datagram.Dispatcher.handle_write (self)
+                if not self.output_fifo:
+                        self.source_done ()
+
+
+# Benchmarks
+
+def echo (clients=16, messages=1000, size=64):
+        "echo lines through a loopback TCP server, one at a time per client"
+        histogram = async_loop.Histogram ()
+        line = 'x' * (size - 1) + '\n'
+        listen = async_server.Listen (Echo, ('127.0.0.1', 0), 1, clients)
+        addr = listen.socket.getsockname ()
+        pinging = [clients, 0.0]
+        def done (dispatcher):
+                dispatcher.close_when_done ()
+                pinging[0] -= 1
+                if pinging[0] == 0:
+                        pinging[1] = time.time ()
+                        listen.server_shutdown ()
+                        
+        async_loop._meters = async_loop.Meters ()
+        started = time.time ()
+        for i in xrange (clients):
+                async_client.connect (
+                        Ping (line, messages, histogram, done), addr
+                        )
+        async_loop.dispatch ()
+        elapsed = pinging[1] - started
+        metered = phases ()
+        async_loop._meters = None
+        count = clients * messages
+        return [
+                ('messages', count), 
+                ('messages/s', count / elapsed),
+                ('bytes/s', 2 * count * size / elapsed)
+                ] + percentiles ('rtt', histogram) + metered
+        
+def idle (connections=1000, active=16, messages=100, size=64, Idle=Idle):
+        "ping an active set of socketpairs among idle ones"
+        available = (descriptors (2 * (connections + active) + 64) - 64) / 2
+        connections = max (0, min (connections, available - active))
+        before = rss ()
+        idles = []
+        for i in xrange (connections):
+                left, right = socket.socketpair ()
+                Idle ().set_connection (left, 'idle')
+                idles.append (right)
+        memory = rss () - before
+        histogram = async_loop.Histogram ()
+        line = 'x' * (size - 1) + '\n'
+        pinging = [active, 0.0]
+        def done (dispatcher):
+                pinging[0] -= 1
+                if pinging[0] == 0:
+                        pinging[1] = time.time ()
+                        for right in idles:
+                                right.close ()
+                                
+                dispatcher.close_when_done ()
+                        
+        pings = []
+        for i in xrange (active):
+                left, right = socket.socketpair ()
+                Echo ().set_connection (left, 'echo')
+                ping = Ping (line, messages, histogram, done)
+                ping.set_connection (right, 'ping')
+                pings.append (ping)
+        async_loop._meters = async_loop.Meters ()
+        started = time.time ()
+        for ping in pings:
+                ping.ping ()
+        del pings
+        async_loop.dispatch ()
+        elapsed = pinging[1] - started
+        metered = phases ()
+        async_loop._meters = None
+        count = active * messages
+        return [
+                ('connections', connections),
+                ('bytes/connection', memory / max (connections, 1)),
+                ('messages/s', count / elapsed)
+                ] + percentiles ('rtt', histogram) + metered
+        #
+        # each idle connection holds a dispatcher and both ends of a pair of
+        # sockets, its memory is their resident size. The count of idle
+        # connections is capped by the limit of file descriptors.
+
+def chatted (connections=10000, size=64):
+        "return the resident size of chat connections that received input"
+        available = (descriptors (2 * connections + 64) - 64) / 2
+        connections = max (0, min (connections, available))
+        line = 'x' * (size - 1) + '\n'
+        before = rss ()
+        rights = []
+        measured = [0, 0]
+        def done (dispatcher):
+                measured[0] += 1
+                if measured[0] == connections:
+                        measured[1] = rss () - before
+                        for right in rights:
+                                right.close ()
+                        
+        for i in xrange (connections):
+                left, right = socket.socketpair ()
+                Chatted (done).set_connection (left, 'chatted')
+                right.sendall (line + line[:size / 2])
+                rights.append (right)
+        async_loop.dispatch ()
+        return [
+                ('connections', connections),
+                ('bytes/connection', measured[1] / max (connections, 1))
+                ]
+        #
+        # each connection received a line and half of the next one, it 
+        # is left idle with an incomplete line: its memory is what a chat
+        # dispatcher keeps between reads, with its pair of sockets.
+
+def footprint (Dispatcher, count=100000):
+        "return the resident size of metered server dispatchers"
+        now = time.time ()
+        before = rss ()
+        dispatchers = []
+        for i in xrange (count):
+                dispatcher = Dispatcher ()
+                dispatcher.addr = ('127.0.0.1', i)
+                dispatcher._fileno = i
+                dispatcher.connected = True
+                dispatcher.server_name = '127.0.0.1'
+                dispatcher.server_when = now
+                async_server.meter (dispatcher, now)
+                dispatcher.limit_inactive = 1<<32
+                dispatchers.append (dispatcher)
+        memory = rss () - before
+        return [
+                ('dispatchers', count),
+                ('bytes/dispatcher', memory / count)
+                ]
+        #
+        # the attributes that async_server sets on an accepted dispatcher,
+        # without a socket: what a dispatcher costs by itself, dictionary 
+        # and meter closures included or not. The dispatchers are left to
+        # the forked process that runs the benchmark.
+
+def datagrams (count=100000, size=64, batch=64, limited=False):
+        "send datagrams through loopback UDP, batched at each event"
+        data = 'x' * size
+        sent = [0.0]
+        def received ():
+                sink.close ()
+                
+        def drained (when):
+                sink.close ()
+                
+        def done ():
+                sent[0] = time.time ()
+                source.close ()
+                if not sink.closing:
+                        async_loop.schedule (sent[0] + 0.25, drained)
+                
+        sink = Sink (count, received)
+        sink.async_datagram_bind (('127.0.0.1', 0))
+        async_core.socket_tune (
+                sink.socket, async_core.socket_options (('bulk', ))
+                )
+        peer = sink.socket.getsockname ()
+        source = Source (done)
+        source.async_datagram_bind (('127.0.0.1', 0))
+        sink.ac_in_batch = source.ac_out_batch = batch
+        if limited:
+                unlimited = (lambda: 1 << 40)
+                async_limits.limit_datagram (
+                        sink, 1, 60, unlimited, unlimited
+                        )
+                async_limits.limit_datagram (
+                        source, 1, 60, unlimited, unlimited
+                        )
+        for i in xrange (count):
+                source.async_datagram_push (data, peer)
+        async_loop._meters = async_loop.Meters ()
+        started = time.time ()
+        async_loop.dispatch ()
+        metered = phases ()
+        async_loop._meters = None
+        received = sink.sink_received
+        results = [
+                ('datagrams', count),
+                ('sent/s', count / (sent[0] - started)),
+                ('received/s', received / (sink.sink_when - started)),
+                ('lost', count - received)
+                ]
+        if limited:
+                results.append (('metered', sink.ac_in_meter))
+        return results + metered
+        #
+        # datagrams dropped by a full receive buffer are counted as lost,
+        # the sink waits a quarter of a second for the last ones after
+        # the source sent them all.
+
+def timers (count=100000, span=1.0):
+        "schedule timers over a span, cancel half, reschedule a quarter"
+        histogram = async_loop.Histogram ()
+        def fired (when):
+                histogram.add (time.time () - when)
+                
+        random.seed (count)
+        now = time.time () + span
+        whens = [now + random.random () * span for i in xrange (count)]
+        started = time.time ()
+        handles = [async_loop.schedule (when, fired) for when in whens]
+        scheduling = time.time () - started
+        started = time.time ()
+        for handle in handles[::2]:
+                handle.cancel ()
+        cancelling = time.time () - started
+        started = time.time ()
+        for handle in handles[1::4]:
+                handle.reschedule (handle.when + span / 2)
+        rescheduling = time.time () - started
+        del handles
+        async_loop._meters = async_loop.Meters ()
+        async_loop.dispatch ()
+        metered = phases ()
+        async_loop._meters = None
+        return [
+                ('timers', count),
+                ('schedule/s', count / scheduling),
+                ('cancel/s', count / 2 / cancelling),
+                ('reschedule/s', count / 4 / rescheduling),
+                ('fired', histogram.histogram_count)
+                ] + percentiles ('late', histogram) + metered
+
+def finalizations (count=100000):
+        "finalize a storm of instances dereferenced at once"
+        finalized = [0]
+        def finalize (instance):
+                finalized[0] += 1
+                
+        instances = []
+        for i in xrange (count):
+                instance = finalization.Finalization ()
+                instance.finalization = finalize
+                instances.append (instance)
+        del instance
+        started = time.time ()
+        del instances
+        queued = time.time () - started
+        started = time.time ()
+        async_loop.dispatch ()
+        finalizing = time.time () - started
+        assert finalized[0] == count
+        return [
+                ('finalizations', count),
+                ('queue/s', count / queued),
+                ('finalize/s', count / finalizing)
+                ]
+
+def thunks (count=100000):
+        "thunk calls from a thread into the loop through a select trigger"
+        histogram = async_loop.Histogram ()
+        def thunked (when):
+                histogram.add (time.time () - when)
+                
+        trigger = select_trigger.Trigger ()
+        def pull ():
+                for i in xrange (count):
+                        trigger ((thunked, (time.time (), )))
+                trigger ((trigger.handle_close, ()))
+                
+        started = time.time ()
+        thread = threading.Thread (target=pull)
+        thread.start ()
+        async_loop.dispatch ()
+        elapsed = time.time () - started
+        thread.join ()
+        return [
+                ('thunks', histogram.histogram_count), 
+                ('thunks/s', histogram.histogram_count / elapsed)
+                ] + percentiles ('latency', histogram)
+
+
+# Results
+
+def isolated (benchmark, args):
+        "run a benchmark in a forked process, return its results"
+        r, w = os.pipe ()
+        pid = os.fork ()
+        if pid == 0:
+                os.close (r)
+                try:
+                        async_loop.forked (async_loop)
+                        os.write (w, dumps (benchmark (*args)))
+                except:
+                        loginfo.traceback ()
+                        os._exit (1)
+                        
+                os._exit (0)
+                        
+        os.close (w)
+        encoded = []
+        while True:
+                data = os.read (r, 4096)
+                if not data:
+                        break
+                
+                encoded.append (data)
+        os.close (r)
+        pid, status = os.waitpid (pid, 0)
+        if status != 0:
+                raise RuntimeError, 'benchmark %s failed, status %d' % (
+                        benchmark.__name__, status
+                        )
+                
+        return loads (''.join (encoded))
+        #
+        # each benchmark starts with the memory and the loop state of its
+        # parent, the resident size it grows and the dispatchers it leaves
+        # do not bias the next one. A benchmark that fails exits its 
+        # process with a non-zero status, it does not yield truncated 
+        # results.
+
+def run (suite):
+        "run a suite of (name, benchmark, args), yield (name, metric, value)"
+        for name, benchmark, args in suite:
+                for metric, value in isolated (benchmark, args):
+                        yield name, metric, value
+
+def dumps (results):
+        "encode results as netstrings of names followed by a value"
+        return netstring.encode ([
+                netstring.encode (result[:-1] + (repr (result[-1]), ))
+                for result in results
+                ])
+
+def loads (encoded):
+        "decode netstrings of names followed by a value"
+        results = []
+        for result in netstring.decode (encoded):
+                result = tuple (netstring.decode (result))
+                try:
+                        value = int (result[-1].rstrip ('L'))
+                except ValueError:
+                        value = float (result[-1])
+                results.append (result[:-1] + (value, ))
+        return results
+
+def compare (before, after):
+        "yield (name, metric, before, after, ratio) for metrics in both"
+        values = dict ((
+                ((name, metric), value) for name, metric, value in before
+                ))
+        for name, metric, value in after:
+                try:
+                        was = values[(name, metric)]
+                except KeyError:
+                        continue
+                
+                if was:
+                        yield name, metric, was, value, float (value) / was
+                else:
+                        yield name, metric, was, value, 0.0
+                                
+
+def suite (sizes=(1000, 10000, 50000)):
+        "return the default suite, with idle connections of each size"
+        return [
+                ('echo', echo, ()),
+                ] + [
+                ('idle-%d' % size, idle, (size, )) for size in sizes
+                ] + [
+                ('idle-slots-%d' % size, idle, (
+                        size, 16, 100, 64, Idle_with_slots
+                        )) for size in sizes
+                ] + [
+                ('chatted', chatted, ()),
+                ('chat', footprint, (async_chat.Dispatcher, )),
+                ('chat-slots', footprint, (async_chat.Dispatcher_with_slots, )),
+                ('net', footprint, (async_net.Dispatcher, )),
+                ('net-slots', footprint, (async_net.Dispatcher_with_slots, )),
+                ('datagrams', datagrams, ()),
+                ('datagrams-1', datagrams, (100000, 64, 1)),
+                ('datagrams-limit', datagrams, (100000, 64, 64, True)),
+                ('timers', timers, ()),
+                ('finalizations', finalizations, ()),
+                ('thunks', thunks, ())
+                ]
+
+
+if __name__ == '__main__':
+        assert None == sys.stderr.write (
+                'Allegra Benchmark'
+                ' - Copyright 2005 Laurent A.V. Szyster'
+                ' | Copyleft GPL 2.0\n\n'
+                )
+        loginfo.toggle (False)
+        if len (sys.argv) > 3 and sys.argv[1] == 'compare':
+                for result in compare (
+                        loads (open (sys.argv[2], 'rb').read ()),
+                        loads (open (sys.argv[3], 'rb').read ())
+                        ):
+                        sys.stderr.write (
+                                '%-14s %-16s %14g %14g %8.3f\n' % result
+                                )
+                sys.exit (0)
+                
+        if len (sys.argv) > 2:
+                sizes = [int (arg) for arg in sys.argv[2:]]
+        else:
+                sizes = (1000, 10000, 50000)
+        sys.stderr.write ('backend %s\n\n' % async_loop._io.func_name)
+        results = []
+        for result in run (suite (sizes)):
+                sys.stderr.write ('%-14s %-16s %14g\n' % result)
+                results.append (result)
+        if len (sys.argv) > 1:
+                open (sys.argv[1], 'wb').write (dumps (results))
+        sys.exit (0)
+        
+# SYNOPSIS
+#
+# python benchmark.py [results.net [idle connections ...]]
+#
+# python benchmark.py compare before.net after.net
+#
+# Run the suite and maybe save its results as netstrings, or compare the
+# results of two runs, for instance before and after a commit. Each line
+# of the comparison ends with the ratio after/before: above 1 is better
+# for rates, worse for latencies.
\ No newline at end of file
@@ -23,10 +23,13 @@ from allegra import loginfo, async_loop
 
 # Finalize
 
-class Finalization (object):
+class Finalization_base (object):
+
+        __slots__ = ()
 
         finalization = None
         
+        async_loop = async_loop
         async_finalized = async_loop._finalized
 
         def __del__ (self):
@@ -34,6 +37,11 @@ class Finalization (object):
                          self.async_finalized.append (self)
 
 
+class Finalization (Finalization_base): pass
+
+# Finalization_base has no __dict__, slotted dispatchers mix it in instead.
+
+
 def collect ():
         import gc
         collected = gc.collect ()
@@ -74,6 +82,7 @@ def branch (branched, finalization):
 class Continuation (object):
 
         finalization = None
+        async_loop = async_loop
         async_finalized = async_loop._finalized
         
         def __call__ (self): pass
@@ -145,7 +145,9 @@ sys.excepthook = _excepthook
 
 # a class interface to mix in
 
-class Loginfo (object):
+class Loginfo_base (object):
+
+	__slots__ = ()
 
 	loginfo_logger = logger
 	
@@ -202,8 +204,13 @@ class Loginfo (object):
 		return ctb
                 
 
-def toggle (logging=None, Class=Loginfo):
-	"toggle logging on/off for the Class specified or Loginfo"
+class Loginfo (Loginfo_base): pass
+
+# Loginfo_base has no __dict__, slotted dispatchers mix it in instead.
+                
+
+def toggle (logging=None, Class=Loginfo_base):
+	"toggle logging on/off for the Class specified or all Loginfo"
 	if logging == None:
 		if Class.log == Class.loginfo_null:
 			Class.log = Class.loginfo_log
@@ -0,0 +1,277 @@
+# Copyright (C) 2005 Laurent A.V. Szyster
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+#    http://www.gnu.org/copyleft/gpl.html
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+
+"http://laurentszyster.be/blog/prefork/"
+
+import os, signal, select, errno, time
+
+from allegra import loginfo, async_loop, async_server
+
+
+def _cpus ():
+        try:
+                return max (os.sysconf ('SC_NPROCESSORS_ONLN'), 1)
+                
+        except (AttributeError, ValueError, OSError):
+                return 1
+
+
+class Prefork (loginfo.Loginfo):
+        
+        "fork and supervise worker processes, each with its own listener"
+        
+        prefork_when = 0.0
+        prefork_stopping = False
+        prefork_lifetime = 1.0
+        prefork_backoff_max = 30.0
+        ac_in_meter = ac_out_meter = server_dispatched = 0
+        
+        def __init__ (
+                self, Listen, args, workers=None, 
+                reuse_port=(async_server.SO_REUSEPORT != None)
+                ):
+                self.prefork_Listen = Listen
+                self.prefork_args = args
+                self.prefork_workers = workers or _cpus ()
+                self.prefork_reuse_port = reuse_port
+                self.prefork_pipes = {}
+                self.prefork_buffers = {}
+                self.prefork_forked = {}
+                self.prefork_restarts = []
+                self.prefork_backoff = 0.0
+                if reuse_port:
+                        self.prefork_listen = None
+                else:
+                        self.prefork_listen = Listen (*args)
+                        self.prefork_listen.del_channel ()
+                #
+                # without SO_REUSEPORT, the listener is bound and listen in
+                # the parent but not dispatched there: the workers inherit 
+                # it and add it to their own loop, all accepting from the
+                # same backlog.
+        
+        def __repr__ (self):
+                return 'prefork id="%x"' % id (self)
+        
+        def prefork_fork (self):
+                "fork a worker process, return its pid in the parent"
+                r, w = os.pipe ()
+                pid = os.fork ()
+                if pid == 0:
+                        os.close (r)
+                        for fd in self.prefork_pipes.values ():
+                                os.close (fd)
+                        try:
+                                self.prefork_work (w)
+                        except:
+                                loginfo.traceback ()
+                        os._exit (0)
+                
+                os.close (w)
+                self.prefork_pipes[pid] = r
+                self.prefork_forked[pid] = time.time ()
+                self.prefork_buffers[r] = ''
+                assert None == self.log ('fork pid="%d"' % pid, 'debug')
+                return pid
+                
+        def prefork_work (self, pipe):
+                "dispatch a listener in the worker, report its meters"
+                signal.signal (signal.SIGTERM, _terminate)
+                async_loop.forked (async_loop)
+                if self.prefork_reuse_port:
+                        Listen = self.prefork_Listen
+                        Listen.server_reuse_port = True
+                        listen = Listen (*self.prefork_args)
+                else:
+                        listen = self.prefork_listen
+                        listen.add_channel ()
+                server_stop = listen.server_stop
+                def report (when):
+                        os.write (pipe, '%d %d %d\n' % (
+                                listen.server_dispatched,
+                                listen.ac_in_meter, 
+                                listen.ac_out_meter
+                                ))
+                        server_stop (when)
+                        
+                listen.server_stop = report
+                def shutdown ():
+                        if listen.accepting:
+                                listen.server_shutdown ()
+                        return True
+                        
+                async_loop.catch (shutdown)
+                async_loop.dispatch ()
+                #
+                # a worker terminated or interrupted shuts its listener 
+                # down and exits once its dispatchers are closed, after
+                # reporting the meters of the last server stop.
+                
+        def prefork_start (self):
+                "fork all workers and supervise them until they exit"
+                self.prefork_when = time.time ()
+                self.log ('start workers="%d"' % self.prefork_workers, 'info')
+                for i in xrange (self.prefork_workers):
+                        self.prefork_fork ()
+                signal.signal (signal.SIGTERM, _terminate)
+                while self.prefork_pipes or self.prefork_restarts:
+                        try:
+                                self.prefork_supervise ()
+                        except async_loop.Exit:
+                                self.prefork_stop ()
+                self.prefork_stopped ()
+                
+        def prefork_supervise (self):
+                "read the meters reported, reap and restart dead workers"
+                pipes = self.prefork_buffers.keys ()
+                try:
+                        readable = select.select (
+                                pipes, [], [], async_loop.precision
+                                )[0]
+                except select.error, error:
+                        if error[0] != errno.EINTR:
+                                raise
+                                
+                        readable = ()
+                for fd in readable:
+                        data = os.read (fd, 4096)
+                        if data:
+                                self.prefork_collect (fd, data)
+                        else:
+                                del self.prefork_buffers[fd] # closed
+                for worker in self.prefork_pipes.keys ():
+                        try:
+                                pid, status = os.waitpid (worker, os.WNOHANG)
+                        except OSError, error:
+                                if error[0] == errno.EINTR:
+                                        continue
+                                
+                                if error[0] != errno.ECHILD:
+                                        raise
+                                
+                                pid, status = worker, -1 # reaped elsewhere
+                        if pid == worker:
+                                self.prefork_exited (pid, status)
+                if self.prefork_restarts:
+                        now = time.time ()
+                        restarts = self.prefork_restarts
+                        self.prefork_restarts = [
+                                when for when in restarts if when > now
+                                ]
+                        for i in xrange (
+                                len (restarts) - len (self.prefork_restarts)
+                                ):
+                                self.prefork_fork ()
+                #
+                # only the workers are waited for, other children of the 
+                # process are left to whoever forked them. 
+                        
+        def prefork_collect (self, fd, data):
+                "aggregate the meters reported by a worker"
+                lines = (self.prefork_buffers[fd] + data).split ('\n')
+                self.prefork_buffers[fd] = lines.pop ()
+                for line in lines:
+                        dispatched, ac_in, ac_out = [
+                                int (meter) for meter in line.split (' ')
+                                ]
+                        self.server_dispatched += dispatched
+                        self.ac_in_meter += ac_in
+                        self.ac_out_meter += ac_out
+                        
+        def prefork_exited (self, pid, status):
+                "close the pipe of a dead worker, maybe restart another one"
+                fd = self.prefork_pipes.pop (pid)
+                lifetime = time.time () - self.prefork_forked.pop (pid)
+                if self.prefork_buffers.has_key (fd):
+                        while True:
+                                data = os.read (fd, 4096)
+                                if not data:
+                                        break
+                                
+                                self.prefork_collect (fd, data)
+                        del self.prefork_buffers[fd]
+                os.close (fd)
+                if self.prefork_stopping:
+                        assert None == self.log (
+                                'exit pid="%d" status="%d"' % (pid, status),
+                                'debug'
+                                )
+                else:
+                        if lifetime < self.prefork_lifetime:
+                                self.prefork_backoff = min (max (
+                                        self.prefork_backoff * 2, 
+                                        async_loop.precision
+                                        ), self.prefork_backoff_max)
+                        else:
+                                self.prefork_backoff = 0.0
+                        self.log (
+                                'restart pid="%d" status="%d" delay="%f"' % (
+                                        pid, status, self.prefork_backoff
+                                        ), 'error'
+                                )
+                        self.prefork_restarts.append (
+                                time.time () + self.prefork_backoff
+                                )
+                #
+                # workers that die sooner than prefork_lifetime after they
+                # were forked are restarted after a delay that doubles up
+                # to prefork_backoff_max, so that a worker failing at start
+                # is not forked again and again at each supervision.
+                
+        def prefork_stop (self):
+                "terminate all workers, they will not be restarted"
+                self.prefork_stopping = True
+                self.prefork_restarts = []
+                for pid in self.prefork_pipes.keys ():
+                        try:
+                                os.kill (pid, signal.SIGTERM)
+                        except OSError:
+                                pass # exited allready
+                
+        def prefork_stopped (self):
+                "log the meters aggregated from all workers"
+                self.log (
+                        'stop dispatched="%d"'
+                        ' seconds="%f" in="%d" out="%d"' % (
+                                self.server_dispatched,
+                                (time.time () - self.prefork_when),
+                                self.ac_in_meter,
+                                self.ac_out_meter
+                                ), 'info')
+                if self.prefork_listen != None:
+                        self.prefork_listen.socket.close ()
+                        self.prefork_listen = None
+                        
+
+def _terminate (signum, frame):
+        raise async_loop.Exit
+
+
+# Note about this implementation
+#
+# A prefork group runs one loop per process: the module's default loop
+# in each worker, restarted by the parent when it dies and terminated 
+# when the parent is interrupted or terminated. Connections are owned by
+# the worker that accepted them, either from its own listener bound with
+# SO_REUSEPORT - the kernel shards connections among them - or from the
+# listener shared by all workers - then each accepts what it can, and
+# the others' accept fail with EWOULDBLOCK.
+#
+# The worker's meters are reported to the parent at each server stop, as
+# a line written to a pipe, so that the parent's stop log covers the
+# whole group like a single Listen's would.
\ No newline at end of file
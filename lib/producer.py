@@ -18,7 +18,7 @@
 "http://laurentszyster.be/blog/producer/"
 
 
-import types
+import os, types, errno
 
 
 class File (object):
@@ -36,6 +36,72 @@ class File (object):
                 return False
         
 
+class Sendfile (object):
+        
+        "producer of a file's bytes, sent from its descriptor if possible"
+        
+        sendfile_copy = False
+        
+        def __init__ (self, file, offset=0, count=None, chunk=1<<16):
+                self.file = file
+                if count == None:
+                        count = os.fstat (file.fileno ()).st_size - offset
+                self.sendfile_offset = offset
+                self.sendfile_end = offset + count
+                self.chunk = chunk
+                
+        def more (self):
+                "read a chunk at the offset, the copy fallback"
+                count = min (
+                        self.chunk, self.sendfile_end - self.sendfile_offset
+                        )
+                if count < 1:
+                        return ''
+                
+                self.file.seek (self.sendfile_offset)
+                data = self.file.read (count)
+                if data:
+                        self.sendfile_offset += len (data)
+                else:
+                        self.sendfile_end = self.sendfile_offset
+                return data
+        
+        def producer_stalled (self):
+                return False
+        
+        def producer_sendfile (self, dispatcher):
+                "try to send a chunk, return the bytes sent or None to copy"
+                count = min (
+                        self.chunk, self.sendfile_end - self.sendfile_offset
+                        )
+                if count < 1 or self.sendfile_copy or not hasattr (
+                        dispatcher, 'sendfile'
+                        ):
+                        return None
+                
+                fd = self.file.fileno ()
+                try:
+                        sent = dispatcher.sendfile (
+                                fd, self.sendfile_offset, count
+                                )
+                except (OSError, IOError), error:
+                        if error[0] in (errno.EINVAL, errno.ENOSYS):
+                                self.sendfile_copy = True
+                                return None
+                        
+                        raise
+                        
+                if sent > 0:
+                        self.sendfile_offset += sent
+                elif os.fstat (fd).st_size <= self.sendfile_offset:
+                        self.sendfile_end = self.sendfile_offset # truncated
+                return sent
+        #
+        # the kernel copies the file to the socket, partial sends move the
+        # offset in the file. When sendfile is not available, or not for
+        # this pair of descriptors, the copy path of more is used instead.
+
+
 class Simple (object):
         
         "scanning producer for a large string"
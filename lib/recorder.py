@@ -0,0 +1,288 @@
+# Copyright (C) 2005 Laurent A.V. Szyster
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+#    http://www.gnu.org/copyleft/gpl.html
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"http://laurentszyster.be/blog/recorder/"
+
+import time, threading
+
+from allegra import (
+        netstring, loginfo, async_loop, thread_loop, select_trigger
+        )
+
+
+# Record
+
+class Writer (threading.Thread):
+        
+        "write the chunks queued to a file, until None is queued"
+        
+        def __init__ (self, file):
+                self.writer_file = file
+                self.writer_queue = thread_loop.Protected_deque ()
+                threading.Thread.__init__ (self)
+                self.setDaemon (1)
+                
+        def run (self):
+                next = self.writer_queue.popleft
+                write = self.writer_file.write
+                while True:
+                        chunk = next ()
+                        if chunk == None:
+                                break
+                                
+                        write (chunk)
+                self.writer_file.close ()
+                
+
+class Recorder (async_loop.Profile):
+        
+        "record the events handled by a loop as netstrings"
+        
+        recorder_polled = 0.0
+        recorder_polls = 0
+        
+        def __init__ (self, file, size=1024, sample=1):
+                async_loop.Profile.__init__ (self, 1<<32)
+                self.recorder_size = size
+                self.recorder_sample = sample
+                self.recorder_buffer = []
+                self.recorder_writer = Writer (file)
+                self.recorder_writer.start ()
+        
+        def profile_polled (self, events):
+                "record the time, the number and a sample of events polled"
+                self.recorder_polled = now = time.time ()
+                self.recorder_polls += 1
+                if self.recorder_polls % self.recorder_sample:
+                        self.recorder_record (
+                                ('poll', repr (now), str (len (events)))
+                                )
+                else:
+                        self.recorder_record ((
+                                'poll', repr (now), str (len (events))
+                                ) + tuple ([
+                                        '%d:%x' % event for event in events
+                                        ]))
+                
+        def profile_io (self, dispatcher, read, write):
+                "handle and record the I/O events of a dispatcher"
+                entered = time.time ()
+                try:
+                        if read:
+                                dispatcher.handle_read_event ()
+                        if write:
+                                dispatcher.handle_write_event ()
+                finally:
+                        self.recorder_record ((
+                                'io', repr (entered), 
+                                repr (time.time () - entered),
+                                '%x' % id (dispatcher),
+                                str (dispatcher._fileno), 
+                                'r' * bool (read) + 'w' * bool (write),
+                                dispatcher.__class__.__name__
+                                ))
+                                
+        def profile_call (self, called, instance, *args):
+                "call and record a timer, deferred call, thunk or finalization"
+                entered = time.time ()
+                try:
+                        return called (*args)
+                
+                finally:
+                        seconds = time.time () - entered
+                        name = async_loop._profile_name (
+                                async_loop._profile_key (called)
+                                )
+                        if isinstance (instance, async_loop.Scheduled):
+                                event = (
+                                        'timer', repr (entered), 
+                                        repr (seconds), name, 
+                                        repr (args[0])
+                                        )
+                        elif isinstance (instance, select_trigger.Trigger):
+                                event = (
+                                        'thunk', repr (entered), 
+                                        repr (seconds), name
+                                        )
+                        elif instance is called:
+                                event = (
+                                        'soon', repr (entered), 
+                                        repr (seconds), name
+                                        )
+                        else:
+                                event = (
+                                        'finalize', repr (entered), 
+                                        repr (seconds), name
+                                        )
+                        self.recorder_record (event)
+        
+        def recorder_record (self, event):
+                "buffer an event, queue the buffer to the writer when full"
+                buffer = self.recorder_buffer
+                buffer.append (netstring.encode ((netstring.encode (event), )))
+                if len (buffer) >= self.recorder_size:
+                        self.recorder_flush ()
+                        
+        def recorder_flush (self):
+                "queue the events buffered to the writer"
+                self.recorder_writer.writer_queue (
+                        ''.join (self.recorder_buffer)
+                        )
+                self.recorder_buffer = []
+                
+        def recorder_close (self):
+                "flush, stop the writer and wait for its last write"
+                self.recorder_flush ()
+                self.recorder_writer.writer_queue (None)
+                self.recorder_writer.join ()
+        #
+        # a recorder is a profile that records instead of accounting: it
+        # replaces the loop's profile, if any, and is called at the same
+        # places. Events are encoded in the loop's thread, buffered and
+        # written to the file by another one.
+
+
+def record (loop, filename, size=1024, sample=1):
+        "record the events handled by a loop in a file, size by size"
+        loop._profiled = Recorder (open (filename, 'wb'), size, sample)
+        loginfo.log ('recorded filename="%s"' % filename, 'info')
+
+def unrecord (loop):
+        "stop recording the events of a loop, close its file"
+        recorder = loop._profiled
+        loop._profiled = None
+        recorder.recorder_close ()
+        loginfo.log ('unrecorded', 'info')
+        
+
+# Analyze
+
+def events (file, size=16384):
+        "decode the events recorded in a file, yield tuples of strings"
+        for encoded in netstring.netpipe ((lambda: file.read (size))):
+                yield tuple (netstring.decode (encoded))
+
+def analyze (events):
+        "return the timelines, the occupancy and the delays of events"
+        timelines = {}
+        delays = {}
+        busy = 0.0
+        first = last = polled = None
+        for event in events:
+                kind = event[0]
+                when = float (event[1])
+                if first == None:
+                        first = when
+                if kind == 'poll':
+                        polled = last = when
+                        continue
+                        
+                seconds = float (event[2])
+                if when + seconds > last:
+                        last = when + seconds
+                if kind != 'thunk':
+                        busy += seconds # thunks are handled in I/O
+                if kind == 'timer':
+                        delay = when - float (event[4])
+                elif polled != None and kind in ('io', 'thunk'):
+                        delay = when - polled
+                else:
+                        delay = None
+                if delay != None:
+                        try:
+                                histogram = delays[kind]
+                        except KeyError:
+                                histogram = delays[kind] = \
+                                        async_loop.Histogram ()
+                        histogram.add (max (delay, 0.0))
+                if kind == 'io':
+                        try:
+                                timelines[event[3]].append (
+                                        (when, seconds, event[5])
+                                        )
+                        except KeyError:
+                                timelines[event[3]] = [
+                                        event[6], event[4], 
+                                        (when, seconds, event[5])
+                                        ]
+        if first == None:
+                return timelines, 0.0, delays
+        
+        return timelines, busy / max (last - first, 1e-6), delays
+        #
+        # a connection is identified by its dispatcher, not its file 
+        # descriptor which is reused after close, and its timeline is
+        # a list of its class name, its descriptor and each handling
+        # of I/O, as (when, seconds, flags). The queueing delay of an
+        # I/O event or a thunk is the time from its poll to its handling,
+        # the one of a timer from its deadline.
+        
+
+if __name__ == '__main__':
+        import sys
+        assert None == sys.stderr.write (
+                'Allegra Recorder'
+                ' - Copyright 2005 Laurent A.V. Szyster'
+                ' | Copyleft GPL 2.0\n\n'
+                )
+        timelines, occupancy, delays = analyze (events (
+                open (sys.argv[1], 'rb')
+                ))
+        sys.stderr.write ('occupancy %f\n\n' % occupancy)
+        for kind, histogram in delays.items ():
+                sys.stderr.write (
+                        '%-8s count="%d" mean="%f" p50="%f" p99="%f"'
+                        ' p999="%f" max="%f"\n' % (
+                                (kind, ) + histogram.stats ()
+                                )
+                        )
+        sys.stderr.write ('\n')
+        for key, timeline in timelines.items ():
+                handled = timeline[2:]
+                busy = sum ([seconds for when, seconds, flags in handled])
+                sys.stderr.write (
+                        '%s fd="%s" id="%s" events="%d" first="%f"'
+                        ' last="%f" busy="%f"\n' % (
+                                timeline[0], timeline[1], key, 
+                                len (handled), handled[0][0], 
+                                handled[-1][0] + handled[-1][1], busy
+                                )
+                        )
+        sys.exit (0)
+
+# SYNOPSIS
+#
+# >>> from allegra import async_loop, recorder
+# >>> recorder.record (async_loop, 'trace.net')
+# >>> async_loop.dispatch ()
+# >>> recorder.unrecord (async_loop)
+#
+# python recorder.py trace.net
+#
+# Each event is a netstring of netstrings, its kind and the time it was
+# handled first, then:
+#
+#        poll     count, fd:flags ...
+#        io       seconds, id, fd, flags, class
+#        timer    seconds, function, deadline
+#        soon     seconds, function
+#        thunk    seconds, function
+#        finalize seconds, function
+#
+# The descriptors polled and their flags, in hexadecimal as poll and
+# epoll return them, are recorded every sample polls, the count of 
+# events at each one. The select backend records POLLIN or POLLOUT.
\ No newline at end of file
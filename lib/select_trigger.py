@@ -50,6 +50,9 @@ class Trigger (async_core.Dispatcher):
 
         "Thunk back safely from threads into the asynchronous loop"
         
+        async_announce = True
+        async_priority = 1
+        
         def __repr__ (self):
                 return 'trigger id="%x"' % id (self)
 
@@ -78,9 +81,15 @@ class Trigger (async_core.Dispatcher):
                         self.thunks = []
                 finally:
                         self.lock.release ()
+                profiled = self.async_loop._profiled
                 for thunk in thunks:
                         try:
-                                thunk[0] (*thunk[1])
+                                if profiled == None:
+                                        thunk[0] (*thunk[1])
+                                else:
+                                        profiled.profile_call (
+                                                thunk[0], self, *thunk[1]
+                                                )
                         except:
                                 self.loginfo_traceback ()
                         
@@ -208,4 +217,43 @@ class Select_trigger (loginfo.Loginfo, finalization.Finalization):
 		if trigger.select_triggers == 0:
 			trigger ((trigger.handle_close, ()))
 			Select_trigger.select_trigger = None
-		self.select_trigger = None
\ No newline at end of file
+		self.select_trigger = None
+
+
+if __name__ == '__main__':
+        import time, threading
+        assert None == sys.stderr.write (
+                'Allegra Select Trigger'
+                ' - Copyright 2005 Laurent A.V. Szyster'
+                ' | Copyleft GPL 2.0\n\n'
+                )
+        # call soon from another thread into a Loop instance, through the
+        # trigger bound to it, and check that the call was made in this 
+        # thread by that loop, not by the module's default loop.
+        loop = async_loop.Loop ()
+        async_loop.trigger (loop)
+        fileno = loop._soon_trigger._fileno
+        called = []
+        def call ():
+                called.append (thread.get_ident ())
+                async_loop.untrigger (loop)
+                
+        def timeout (when):
+                if loop._soon_trigger != None:
+                        async_loop.untrigger (loop)
+                        
+        loop.schedule (time.time () + 3, timeout)
+        threading.Thread (
+                target=loop.call_soon_threadsafe, args=(call, )
+                ).start ()
+        loop.dispatch ()
+        if not (
+                called == [thread.get_ident ()] and 
+                fileno not in async_loop._dispatched and
+                fileno not in loop._dispatched
+                ):
+                sys.stderr.write ('loop trigger failed\n')
+                sys.exit (1)
+                
+        sys.stderr.write ('loop trigger ok\n')
+        sys.exit (0)
\ No newline at end of file
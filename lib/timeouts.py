@@ -24,10 +24,12 @@ from allegra import async_loop
 
 class Timeouts (object):
 	
+        async_loop = async_loop
+        
 	def __init__ (self, period, precision=None):
 		# self.timeouts_timeout = timeout
-		self.timeouts_period = max (period, async_loop.precision)
-		self.timeouts_precision = precision or async_loop.precision
+		self.timeouts_period = max (period, self.async_loop.precision)
+		self.timeouts_precision = precision or self.async_loop.precision
 		self.timeouts_deque = collections.deque ()
                         
         def timeouts_push (self, reference):
@@ -37,8 +39,10 @@ class Timeouts (object):
 		self.timeouts_deque.append ((when, reference))
 		return reference
 	
+        timeouts_scheduled = None
+        
         def timeouts_start (self, when):
-                async_loop.schedule (
+                self.timeouts_scheduled = self.async_loop.schedule (
                         when + self.timeouts_precision, self.timeouts_poll
                         )
                 
@@ -61,7 +65,9 @@ class Timeouts (object):
                 self.timeouts_stop ()
 
 	def timeouts_stop (self):
-                pass # self.timeouts_timeout = None
+                if self.timeouts_scheduled != None:
+                        self.timeouts_scheduled.cancel ()
+                        self.timeouts_scheduled = None
 	
 
 # The first, simplest and probably most interesting application of Timeouts
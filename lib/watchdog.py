@@ -0,0 +1,161 @@
+# Copyright (C) 2005 Laurent A.V. Szyster
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+#    http://www.gnu.org/copyleft/gpl.html
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"http://laurentszyster.be/blog/watchdog/"
+
+import sys, time, thread, threading
+
+from allegra import loginfo, async_loop
+
+
+def stack (frame):
+        "return the compact stack of a frame, from its outermost caller"
+        stacked = []
+        while frame != None:
+                stacked.append ((
+                        frame.f_code.co_filename, 
+                        frame.f_code.co_name,
+                        str (frame.f_lineno)
+                        ))
+                frame = frame.f_back
+        stacked.reverse ()
+        return stacked
+        
+
+_polling = (
+        async_loop._io_select.func_code, 
+        async_loop._io_poll.func_code, 
+        async_loop._io_epoll.func_code
+        )
+
+class Watchdog (threading.Thread, loginfo.Loginfo):
+        
+        "watch the heartbeat of a loop, log the stack of its stalls"
+        
+        watchdog_beat = watchdog_since = None
+        watchdog_waited = 0.0
+        watchdog_stalls = 0
+        watchdog_last = 0.0
+        
+        def __init__ (self, threshold=1.0, ident=None):
+                self.watchdog_threshold = threshold
+                self.watchdog_ident = ident or thread.get_ident ()
+                self.watchdog_histogram = async_loop.Histogram ()
+                self.watchdog_stopped = threading.Event ()
+                threading.Thread.__init__ (self)
+                self.setDaemon (1)
+                
+        def __repr__ (self):
+                return 'watchdog id="%x"' % id (self)
+                
+        def run (self):
+                "check the heartbeat four times per threshold, until stopped"
+                interval = self.watchdog_threshold / 4
+                while not self.watchdog_stopped.isSet ():
+                        self.watchdog_stopped.wait (interval)
+                        self.watchdog_check (time.time ())
+        
+        def watchdog_check (self, now):
+                "begin or end a stall"
+                frame = sys._current_frames ().get (self.watchdog_ident)
+                if (
+                        frame == None or frame.f_code in _polling or
+                        self.watchdog_beat == None
+                        ):
+                        self.watchdog_waited = now
+                        since = None
+                else:
+                        since = max (self.watchdog_beat, self.watchdog_waited)
+                        if now - since < self.watchdog_threshold:
+                                since = None
+                if since == self.watchdog_since:
+                        if since != None:
+                                self.watchdog_last = now - since
+                        return
+                
+                if self.watchdog_since != None:
+                        self.watchdog_stalled (self.watchdog_last)
+                self.watchdog_since = since
+                if since != None:
+                        self.watchdog_last = now - since
+                        self.watchdog_stall (frame, self.watchdog_last)
+                del frame
+                #
+                # a loop waiting for I/O does not beat, it is not stalled,
+                # and a stall that follows a wait begins at most when the
+                # loop was last seen waiting. Out of dispatch there is no
+                # heartbeat to watch.
+        
+        def watchdog_stall (self, frame, seconds):
+                "count a stall and log the stack of the stalled thread"
+                self.watchdog_stalls += 1
+                loginfo.traceback ((
+                        'stall', '%f seconds' % seconds, stack (frame)
+                        ))
+        
+        def watchdog_stalled (self, seconds):
+                "account the duration of a stall ended"
+                self.watchdog_histogram.add (seconds)
+                self.log ('stalled %f seconds' % seconds, 'info')
+                
+        def watchdog_stop (self):
+                "stop watching"
+                self.watchdog_stopped.set ()
+                
+
+def watch (loop, threshold=1.0):
+        "watch a loop dispatched in this thread, log stalls past threshold"
+        loop._watchdog = watchdog = Watchdog (threshold)
+        watchdog.start ()
+        loginfo.log ('watched threshold="%f"' % threshold, 'info')
+        
+def watched (loop):
+        "return (stalls, stalling, mean, p50, p99, p999, max) in seconds"
+        watchdog = loop._watchdog
+        if watchdog.watchdog_since == None:
+                stalling = 0.0
+        else:
+                stalling = watchdog.watchdog_last
+        return (
+                watchdog.watchdog_stalls, stalling
+                ) + watchdog.watchdog_histogram.stats ()[1:]
+                
+def unwatch (loop):
+        "stop watching a loop, log and return its stall statistics"
+        meters = watched (loop)
+        loop._watchdog.watchdog_stop ()
+        loop._watchdog = None
+        loginfo.log (
+                'unwatched stalls="%d" stalling="%f" mean="%f"'
+                ' p50="%f" p99="%f" p999="%f" max="%f"' % meters, 'info'
+                )
+        return meters
+
+# Note about this implementation
+#
+# The loop beats at each iteration of dispatch, the watchdog thread does
+# not beat for it: it looks at the top frame of the loop's thread and
+# tells a poll waiting for I/O events from a handler that blocks.
+#
+# A stall is logged in the 'traceback' category with the stack of the
+# stalled thread as soon as it passes the threshold, while it lasts, and
+# its duration is logged when it ends. Without a stall the thread costs
+# four lookups of the current frames per threshold.
+#
+# >>> from allegra import async_loop, watchdog
+# >>> watchdog.watch (async_loop, 0.5)
+# >>> async_loop.dispatch ()
\ No newline at end of file